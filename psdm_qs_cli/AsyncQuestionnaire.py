@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+asyncio version of the web service calls to the Questionnaire backend.
+The response post-processing is shared with the blocking QuestionnaireClient.
+'''
+import asyncio
+import getpass
+import logging
+
+from six.moves.urllib.parse import urlparse
+
+from .QuestionnaireClient import QuestionnaireResponseProcessor
+from .KerberosAuth import sharedKerberosAuthProvider
+
+logger = logging.getLogger(__name__)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncQuestionnaireClient(QuestionnaireResponseProcessor):
+    """
+    asyncio interface to the LCLS Questionnaire
+
+    All the public methods of QuestionnaireClient are available as coroutines.
+    The number of requests in flight is bounded by a semaphore so that many
+    lookups can be overlapped from one process without overloading the server.
+
+    Parameters
+    ----------
+    url: str, optional
+        Provide a base URL for the Questionnaire. If left as None the
+        appropriate URL will be chosen based on your authentication method
+
+    use_kerberos: bool, optional
+        Use a Kerberos ticket to login to the Questionnaire. This is the
+        default authentication method
+
+    user: str, optional
+        A username for ws_auth sign-in. If not provided the current login name
+        is used
+
+    pw = str, optional
+        A password for ws_auth sign-in. If not provided a password will be
+        requested
+
+    max_concurrency: int, optional
+        The maximum number of requests in flight at any time
+
+    pool_maxsize: int, optional
+        The maximum number of connections kept alive to a single host
+
+    auth_provider: KerberosAuthProvider, optional
+        Caches and refreshes the Kerberos authentication header. Defaults to
+        the provider shared by all the clients in the process
+    """
+    def __init__(self, url=None, use_kerberos=True, user=None, pw=None,
+                 max_concurrency=20, pool_maxsize=20, auth_provider=None):
+        if aiohttp is None:
+            raise RuntimeError('The asyncio client is unavailable.  '
+                               'Please install aiohttp.')
+        self.auth = None
+        self.auth_provider = None
+        if use_kerberos:
+            self.questionnaire_url = url or self.kerb_url
+            self.auth_provider = auth_provider or sharedKerberosAuthProvider()
+            self.host = urlparse(self.questionnaire_url).hostname
+            self.auth_provider.headers(self.host)
+        else:
+            self.questionnaire_url = url or self.wsauth_url
+            # Find the login information if not provided
+            user = user or getpass.getuser()
+            pw = pw or getpass.getpass()
+            self.auth = aiohttp.BasicAuth(user, pw)
+        self.max_concurrency = max_concurrency
+        self.pool_maxsize = pool_maxsize
+        self._semaphore = None
+        self._session = None
+
+    @property
+    def session(self):
+        # The session and the semaphore have to be created inside a running event loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_maxsize)
+            self._session = aiohttp.ClientSession(connector=connector, auth=self.auth)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def close(self):
+        """
+        Close the pooled connections held by this client.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _headers(self):
+        if self.auth_provider is None:
+            return None
+        # Negotiating a Kerberos header blocks; keep it off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(None, self.auth_provider.headers, self.host)
+
+    async def _request(self, method, path, **kwargs):
+        session = self.session
+        async with self._semaphore:
+            for attempt in range(2):
+                headers = await self._headers()
+                async with session.request(method, self.questionnaire_url + path, headers=headers, **kwargs) as r:
+                    if r.status == 401 and headers and attempt == 0:
+                        # The negotiated header has gone stale; renegotiate and try once more.
+                        self.auth_provider.invalidate(self.host, headers)
+                        continue
+                    if r.status <= 299:
+                        return await r.json(content_type=None)
+                    else:
+                        raise Exception("Invalid HTTP status code from server", r.status)
+
+    async def _get(self, path, params=None):
+        return await self._request("GET", path, params=params)
+
+    async def _post(self, path, data):
+        return await self._request("POST", path, data=data)
+
+    async def getEnumerations(self, run):
+        """
+        Get the enumerations in a run period.
+        This returns a list of proposal value names that are comboboxes.
+        :param: run - a run period (for example, run16)
+        """
+        return await self._get("ws/questionnaire/" + run + "/get_enum_field_names")
+
+    async def getProposalsListForRun(self, run):
+        """
+        Get a list of proposals for a run period.
+        :param: run - a run period (for example, run16)
+        """
+        return self._processProposalsList(await self._get("ws/questionnaire/experiments/" + run))
+
+    async def _none(self):
+        return None
+
+    async def getProposalDetailsForRun(self, run, proposalid, fields=None):
+        """
+        Get the detailed list of key value pairs for a proposal in a run period.
+        The attribute and URAWI calls are issued concurrently.
+        :param: run - a run period (for example, run16)
+        :param: proposalid - the proposal id, (for example, LR01)
+        :param: fields - if provided, only the calls and computations needed for these fields are made
+        """
+        needAttributes, needURAWI, needBe = self._detailsNeeded(fields)
+        proposalData, urawiData = await asyncio.gather(
+            self._get("ws/proposal/attribute/" + run + "/" + proposalid) if needAttributes else self._none(),
+            self._get("ws/questionnaire/urawidata/" + run + "/" + proposalid) if needURAWI else self._none())
+        return self._combineProposalDetails(proposalid, proposalData, urawiData, needBe)
+
+    async def formLabelMappings(self, run):
+        '''
+        The form definitions can include optional reporting labels.
+        This call generates a dict with the mapping between the attribute value name and the reporting label if one exists.
+        The form definitions for all the tabs are fetched concurrently.
+        '''
+        tabNames = await self._get("ws/questionnaire/" + run + "/tabnames")
+        allFormDefinitions = await asyncio.gather(*[self._get("ws/questionnaire/" + run + "/form_data_definitions", {"form_name": formTabName}) for formTabName in tabNames])
+        nameMappings = {}
+        for formDefinitions in allFormDefinitions:
+            self._processFormDefinitions(nameMappings, formDefinitions)
+        return nameMappings
+
+    async def getProposalsStatusForRun(self, run):
+        """
+        Get the changes made for a proposal in a run period; we get a list of who made what change when.
+        :param: run - a run period (for example, run16)
+        """
+        return (await self._get("ws/questionnaire/proposals_status/" + run))['experiment_status']
+
+    async def getProposalsPersonnelForRun(self, run):
+        """
+        Get personnel for all the proposals in a run period.
+        This is a special SLAC only tab containing the list of personnel for a proposal.
+        :param: run - a run period (for example, run16)
+        """
+        return self._processPersonnel((await self._get("ws/questionnaire/proposals_personnel/" + run))['proposals_personnel'])
+
+    async def getExpName2URAWIProposalIDs(self):
+        """
+        Get the best guess for experiment name to URAWI proposal IDs.
+        Returns a dict of experiment name (xppi0915) to URAWI proposal ID (LI09).
+        """
+        return await self._get("ws/questionnaire/getURAWIProposalIds")
+
+    async def lookupByExperimentName(self, experiment_name):
+        """
+        Given an experiment name, try to get the best guess as to the proposal_id and run period.
+        """
+        return await self._get("ws/questionnaire/lookupByExperimentName", {"experiment_name": experiment_name})
+
+    async def updateProposalAttribute(self, run, proposal_id, attrname, attrvalue):
+        """
+        Updates the attribute specified by attrname to the value specified by attrvalue for the
+        proposal specified by proposal_id in the specified run.
+        """
+        return await self._post("ws/proposal/attribute/" + run + "/" + proposal_id, {'run_id': run, 'id': attrname, 'val': attrvalue})
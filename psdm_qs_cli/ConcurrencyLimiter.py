@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+'''
+An adaptive limit on the number of requests in flight to the questionnaire.
+The limit grows additively while the server keeps up and is cut multiplicatively (AIMD, as in TCP congestion control)
+when requests fail or the latency of an endpoint stays well above its long term average.
+'''
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class AIMDConcurrencyLimiter(object):
+    """
+    Thread safe additive increase/multiplicative decrease limit on the requests in flight.
+
+    Parameters
+    ----------
+    initial: int, optional
+        The starting limit
+
+    minimum: int, optional
+        The limit is never cut below this
+
+    maximum: int, optional
+        The limit never grows above this; there is no point in this being more
+        than the number of worker threads making the requests
+
+    decrease: float, optional
+        The factor the limit is multiplied by on congestion
+
+    latency_tolerance: float, optional
+        An endpoint is considered congested once its smoothed latency is this many times
+        its baseline; a moving average of the latency over a much longer window
+
+    patience: int, optional
+        The number of successive congested responses before the limit is cut;
+        a single slow response is just jitter
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease=0.5, latency_tolerance=2.0, patience=3):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.patience = patience
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.inflight = 0
+        # Endpoint to [baseline, smoothed latency, successive congested responses]
+        self.latencies = {}
+        self._sinceDecrease = None
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        '''Wait until there is room under the limit for one more request'''
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.inflight -= 1
+                self._cond.notify_all()
+
+    def onSuccess(self, latency, endpoint=None):
+        '''
+        Report a successful request.
+        :param: latency - The time taken by the request in seconds
+        :param: endpoint - The endpoint called; each endpoint's latency is only compared with its own baseline
+        '''
+        with self._cond:
+            stats = self.latencies.get(endpoint)
+            if stats is None:
+                stats = self.latencies[endpoint] = [latency, latency, 0]
+            # The baseline averages over about 50 responses and the smoothed latency over about 5
+            stats[0] = 0.98*stats[0] + 0.02*latency
+            stats[1] = 0.8*stats[1] + 0.2*latency
+            stats[2] = stats[2] + 1 if stats[1] > self.latency_tolerance*stats[0] else 0
+            if self._sinceDecrease is not None:
+                self._sinceDecrease += 1
+            if stats[2] >= self.patience:
+                self._decrease("latency {:.3f}s against a baseline of {:.3f}s".format(stats[1], stats[0]))
+            else:
+                # About one more request in flight for every limit's worth of successful requests
+                self.limit = min(self.maximum, self.limit + 1.0/self.limit)
+            self._cond.notify_all()
+
+    def onCongestion(self):
+        '''Report a request that failed, timed out or was throttled by the server'''
+        with self._cond:
+            if self._sinceDecrease is not None:
+                self._sinceDecrease += 1
+            self._decrease("an error")
+
+    def _decrease(self, reason):
+        # The requests already in flight when the server got congested all see it; only cut the limit once for them.
+        if self._sinceDecrease is not None and self._sinceDecrease < self.limit:
+            return
+        self.limit = max(self.minimum, self.limit*self.decrease)
+        self._sinceDecrease = 0
+        # Let the smoothed latencies recover from the new limit
+        for stats in self.latencies.values():
+            stats[1], stats[2] = stats[0], 0
+        logger.debug("Reduced the concurrency limit to %.1f because of %s", self.limit, reason)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''
+Checkpoints for the exporters so that an interrupted export can be resumed without refetching the proposals already done.
+The checkpoint is a newline delimited JSON sidecar file next to the export; the first line describes the export and
+each line after that is a completed proposal record. The sidecar is removed once the export has been saved.
+'''
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ExportCheckpoint(object):
+    """
+    A sidecar file with the proposal records completed so far.
+
+    Parameters
+    ----------
+    exportPath: str
+        The file being exported to; the checkpoint is this with a .checkpoint suffix
+
+    params: dict
+        Describes the export (run, attributes etc). A checkpoint made with different parameters is not resumed
+    """
+    def __init__(self, exportPath, params):
+        self.path = exportPath + ".checkpoint"
+        self.params = params
+        self._f = None
+
+    def _load(self):
+        records = {}
+        try:
+            with open(self.path, 'r') as f:
+                lines = iter(f)
+                if json.loads(next(lines)) != self.params:
+                    logger.warning("The checkpoint %s is for a different export; starting over", self.path)
+                    return {}
+                for line in lines:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line is partially written if the export was killed while writing it
+                        break
+                    records[record["proposal_id"]] = record
+        except (IOError, OSError, ValueError, StopIteration):
+            return {}
+        return records
+
+    def start(self, resume=False):
+        '''
+        Start checkpointing; returns a dict of proposal id to the records completed by a previous attempt if resuming.
+        :param: resume - Use the records in an existing checkpoint; otherwise any existing checkpoint is discarded
+        '''
+        completed = self._load() if resume else {}
+        # Rewrite the file so that any partial last line from a killed export is dropped before appending to it
+        tmppath = self.path + ".tmp"
+        with open(tmppath, 'w') as f:
+            f.write(json.dumps(self.params) + "\n")
+            for record in completed.values():
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmppath, self.path)
+        self._f = open(self.path, 'a')
+        if completed:
+            logger.info("Resuming with %d proposals from %s", len(completed), self.path)
+        return completed
+
+    def add(self, record):
+        '''Save a completed proposal record'''
+        self._f.write(json.dumps(record) + "\n")
+        self._f.flush()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def finish(self):
+        '''The export has been saved; the checkpoint is no longer needed'''
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
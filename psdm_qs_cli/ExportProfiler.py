@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+Profiling support for the exporters; used by the --profile and --trace-memory options.
+The proposal details are fetched from worker threads so, before Python 3.12, a profiler is enabled in every thread
+started while profiling and the results are merged at the end; from 3.12 on one profiler sees all the threads.
+The time spent waiting on HTTP is taken from a QuestionnaireMetrics so that it is reported separately from the CPU
+time used by the client.
+'''
+import io
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+class ExportProfiler(object):
+    """
+    Context manager that profiles an export and prints a report when done.
+
+    Parameters
+    ----------
+    profile: bool, optional
+        Profile the export with cProfile and print the sorted stats
+
+    profile_out: str, optional
+        Also dump the raw stats into this file (for pstats/snakeviz)
+
+    trace_memory: bool, optional
+        Trace the memory allocations using tracemalloc and report the peak and the top allocation sites
+
+    metrics: QuestionnaireMetrics, optional
+        The metrics of the client used for the export; the HTTP wait time is taken from these
+
+    sort: str, optional
+        The pstats sort key for the printed stats
+
+    limit: int, optional
+        The number of functions and allocation sites printed
+
+    out: file, optional
+        Where the report is printed; defaults to stderr
+    """
+    def __init__(self, profile=False, profile_out=None, trace_memory=False, metrics=None, sort="cumulative", limit=30, out=None):
+        self.profile = profile
+        self.profile_out = profile_out
+        self.trace_memory = trace_memory
+        self.metrics = metrics
+        self.sort = sort
+        self.limit = limit
+        self.out = out or sys.stderr
+        self._profilers = []
+        self._lock = threading.Lock()
+
+    def _threadProfiler(self, *args):
+        # Called once in each new thread; the new profiler replaces this hook in that thread.
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.metrics is not None:
+            self.metrics.reset()
+        if self.profile:
+            if sys.version_info < (3, 12):
+                threading.setprofile(self._threadProfiler)
+            self._threadProfiler()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        if self.profile:
+            threading.setprofile(None)
+            self._profilers[0].disable()
+        self.report(wall, cpu)
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def report(self, wall, cpu):
+        print("Wall clock time:           {:10.3f}s".format(wall), file=self.out)
+        print("Client CPU (all threads):  {:10.3f}s".format(cpu), file=self.out)
+        if self.metrics is not None:
+            summary = self.metrics.summary()
+            # The requests are concurrent so the HTTP wait is summed over all the threads.
+            print("HTTP wait (all threads):   {:10.3f}s in {} requests ({} errors, {} bytes)".format(
+                summary["latency_sum"], summary["requests"], summary["errors"], summary["bytes"]), file=self.out)
+            print("Mean requests in flight:   {:10.2f}".format(summary["latency_sum"]/wall if wall else 0.0), file=self.out)
+            for endpoint, m in summary["endpoints"].items():
+                print("    {:55s} {:6d} requests {:10.3f}s total {:8.3f}s max".format(endpoint, m["count"], m["latency_sum"], m["latency_max"]), file=self.out)
+        if self.profile:
+            stats = None
+            for profiler in self._profilers:
+                profiler.create_stats()
+                if not profiler.stats:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            if stats is not None:
+                if self.profile_out:
+                    stats.dump_stats(self.profile_out)
+                    print("Saved the profile into", self.profile_out, file=self.out)
+                buf = io.StringIO()
+                stats.stream = buf
+                stats.sort_stats(self.sort).print_stats(self.limit)
+                print(buf.getvalue(), file=self.out)
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            print("Traced memory: {:.1f}MB now, {:.1f}MB peak".format(current/(1024.0*1024.0), peak/(1024.0*1024.0)), file=self.out)
+            for stat in tracemalloc.take_snapshot().statistics("lineno")[:self.limit]:
+                print("    ", stat, file=self.out)
+
+
+def addProfilingArguments(parser):
+    '''Add the --profile and --trace-memory options to a exporter's argument parser'''
+    parser.add_argument('--profile', action="store_true", help="Profile the export using cProfile and print the sorted stats along with the time spent waiting on HTTP.")
+    parser.add_argument('--profile-out', help="With --profile, also dump the raw stats into this file.")
+    parser.add_argument('--profile-sort', default="cumulative", help="The pstats sort key for --profile, for example, tottime.")
+    parser.add_argument('--trace-memory', action="store_true", help="Trace the memory allocations and print the peak and the top allocation sites.")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''
+Kerberos authentication shared by all the questionnaire clients in a process.
+The negotiated header is cached per host and renegotiated when it gets old or when the server answers with a 401.
+'''
+import time
+import logging
+import threading
+from functools import partial
+
+from six.moves.urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def krtcAuthHeaders(host):
+    '''
+    Negotiate the Kerberos authentication headers for a host.
+    krtc is only imported here so that it is not loaded (or missed) unless Kerberos authentication is used.
+    '''
+    try:
+        from krtc import KerberosTicket
+    except ImportError:
+        raise RuntimeError('Kerberos-based authentication unavailable.  '
+                           'Please install krtc.')
+    return KerberosTicket("HTTP@" + host).getAuthHeaders()
+
+
+class KerberosAuthProvider(object):
+    """
+    Thread safe cache of the negotiated Kerberos authentication headers per host.
+
+    Parameters
+    ----------
+    max_age: float, optional
+        Renegotiate a header once it is this many seconds old. Servers reject
+        authenticators outside their clock skew window (5 minutes by default)
+        so this should stay below that
+
+    negotiate: callable, optional
+        Called with a host name to negotiate new headers; defaults to krtc
+    """
+    def __init__(self, max_age=240, negotiate=krtcAuthHeaders):
+        self.max_age = max_age
+        self.negotiate = negotiate
+        self.negotiations = 0
+        self._headers = {}
+        self._lock = threading.Lock()
+
+    def headers(self, host):
+        '''
+        The authentication headers for a host; negotiated if there are none or the cached ones are too old.
+        :param: host - The host name, for example, pswww.slac.stanford.edu
+        '''
+        with self._lock:
+            entry = self._headers.get(host)
+            if entry is None or time.time() - entry[1] > self.max_age:
+                logger.debug("Negotiating Kerberos authentication for %s", host)
+                entry = (self.negotiate(host), time.time())
+                self.negotiations += 1
+                self._headers[host] = entry
+            return dict(entry[0])
+
+    def invalidate(self, host, stale=None):
+        '''
+        Drop the cached headers for a host so that the next request renegotiates.
+        :param: host - The host name
+        :param: stale - If provided, only drop the cached headers if they are still these;
+                        so that many requests failing with the same stale headers renegotiate only once
+        '''
+        with self._lock:
+            entry = self._headers.get(host)
+            if entry is not None and (stale is None or entry[0] == stale):
+                del self._headers[host]
+
+    def requestsAuth(self):
+        '''An auth for a requests.Session that uses this provider'''
+        return KerberosRequestsAuth(self)
+
+
+class KerberosRequestsAuth(object):
+    """
+    requests authentication using a KerberosAuthProvider.
+    A 401 response drops the cached header and the request is resent once with a newly negotiated header.
+    """
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __call__(self, r):
+        host = urlparse(r.url).hostname
+        sent = self.provider.headers(host)
+        r.headers.update(sent)
+        r.register_hook("response", partial(self._handle401, host, sent))
+        return r
+
+    def _handle401(self, host, sent, r, **kwargs):
+        if r.status_code != 401:
+            return r
+        logger.info("Got a 401 from %s; renegotiating Kerberos authentication", host)
+        self.provider.invalidate(host, sent)
+        # Release the connection before resending
+        r.content
+        r.close()
+        prep = r.request.copy()
+        # Only the one retry
+        prep.hooks = {"response": []}
+        prep.headers.update(self.provider.headers(host))
+        retried = r.connection.send(prep, **kwargs)
+        retried.history.append(r)
+        retried.request = prep
+        return retried
+
+
+_sharedProvider = None
+_sharedLock = threading.Lock()
+
+
+def sharedKerberosAuthProvider():
+    '''The KerberosAuthProvider shared by all the clients in this process'''
+    global _sharedProvider
+    with _sharedLock:
+        if _sharedProvider is None:
+            _sharedProvider = KerberosAuthProvider()
+        return _sharedProvider
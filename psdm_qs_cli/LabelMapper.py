@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Rename the attributes of a proposal to their reporting labels.
+'''
+
+
+class LabelMapper(object):
+    """
+    Compiled once per run period from the output of formLabelMappings and then applied to every proposal in the run.
+
+    Attributes whose form definition has a quantity > 1 (for example, xraytech-tech-1, xraytech-tech-2 etc)
+    are collected into an array under their common reporting label (for example, "X-ray Techniques").
+    The array is in the order of the form definitions; empty values are left out.
+
+    Parameters
+    ----------
+    nameMappings: dict
+        The attribute name to reporting label mapping from QuestionnaireClient.formLabelMappings
+
+    formDefinitions: list, optional
+        The form definitions from QuestionnaireClient.formDefinitions; these determine the grouped attributes.
+        If not provided no attributes are grouped
+    """
+    def __init__(self, nameMappings, formDefinitions=None):
+        self.nameMappings = dict(nameMappings)
+        # The index from a grouped reporting label to its member attribute ids; and the position of each member in its array.
+        self.groups = {}
+        self._positions = {}
+        for formDefinition in formDefinitions or []:
+            attrid = formDefinition['attribute_id']
+            if attrid in self.nameMappings and 'quantity' in formDefinition and int(formDefinition['quantity']) > 1:
+                members = self.groups.setdefault(self.nameMappings[attrid], [])
+                if attrid not in self._positions:
+                    self._positions[attrid] = len(members)
+                    members.append(attrid)
+
+    def apply(self, details):
+        '''
+        Return a new dict with the attributes in details renamed to their reporting labels in a single pass.
+        Attributes without a reporting label keep their names.
+        :param: details - The proposal details; for example, from getProposalDetailsForRun
+        '''
+        nameMappings, groups, positions = self.nameMappings, self.groups, self._positions
+        ret, grouped = {}, {}
+        for k, v in details.items():
+            label = nameMappings.get(k, k)
+            if label in groups:
+                if v is not None and v != "":
+                    grouped.setdefault(label, []).append((positions.get(k, len(positions)), k, v))
+            else:
+                ret[label] = v
+        for label, members in grouped.items():
+            ret[label] = [v for _, _, v in sorted(members, key=lambda x: (x[0], x[1]))]
+        return ret
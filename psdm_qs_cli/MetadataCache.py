@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+A bounded in-memory cache for the run scoped metadata (form label mappings, enumerations etc).
+'''
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache(object):
+    """
+    A thread-safe LRU cache with an optional time to live.
+    Keys are tuples whose second element is the run period so that all the entries for a run can be invalidated together.
+
+    Parameters
+    ----------
+    max_entries: int, optional
+        The maximum number of entries; the least recently used entry is evicted
+        once this is exceeded. 0 disables caching
+
+    ttl: float, optional
+        The number of seconds an entry is valid for. If None entries do not expire
+    """
+    def __init__(self, max_entries=64, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        '''
+        Get the value for key; calling compute() to generate it on a miss.
+        A copy of the cached value is returned so that callers may modify it.
+        '''
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                stored, value = self._entries[key]
+                if self.ttl is None or now - stored < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.copy(value)
+                del self._entries[key]
+            self.misses += 1
+        value = compute()
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return copy.copy(value)
+
+    def invalidate(self, run=None):
+        '''Drop all the entries for a run period; or everything if run is None'''
+        with self._lock:
+            if run is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[1] == run]:
+                    del self._entries[key]
+
+    def stats(self):
+        '''The hit/miss counters and the current size; suitable for monitoring'''
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._entries), "max_entries": self.max_entries}
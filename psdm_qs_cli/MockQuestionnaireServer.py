@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+'''
+A local stand in for the questionnaire web service with a synthetic data generator.
+This implements every URL used by the QuestionnaireClient so that exports can be developed and load tested without network access.
+For example, to serve a run with 1000 proposals and 50ms of latency per request
+
+    QSMockServer.py --runs run18 --proposals 1000 --latency 0.05 --port 8080
+
+and then point the exporters at it using --questionnaire_url http://localhost:8080/questionnaire/ --no_kerberos
+'''
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+
+from six.moves.urllib.parse import urlparse, parse_qs
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.BaseHTTPServer import HTTPServer
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENTS = ["AMO", "SXR", "XPP", "XCS", "CXI", "MEC", "MFX"]
+XRAY_TECHNIQUES = ["XPCS", "XES", "XAS", "SAXS", "WAXS", "Diffraction", "Imaging"]
+
+
+def generateSyntheticRun(run, num_proposals=10, num_attributes=50, seed=0):
+    '''
+    Generate the data for a synthetic run period.
+    :param: run - The run period name (for example, run18)
+    :param: num_proposals - The number of proposals in the run
+    :param: num_attributes - The number of free form attributes per proposal in addition to the hutch/xraytech/personnel attributes
+    :param: seed - The random seed; the same arguments always generate the same data
+    Returns a dict used by the MockQuestionnaireServer
+    '''
+    rnd = random.Random(seed)
+    tabs = {
+        "general": [{"attribute_id": "general-attr-{}".format(i), "reporting_label": "General attribute {}".format(i)} if i % 5 == 0 else {"attribute_id": "general-attr-{}".format(i)} for i in range(num_attributes)],
+        "xraytech": [{"attribute_id": "xraytech-tech-{}".format(i), "reporting_label": "X-ray Techniques", "quantity": "3"} for i in range(1, 4)],
+        "hutch": [{"attribute_id": "hutch-be-{}-d1-{}".format(loc, i)} for loc in ["top", "mid", "bot", "sam"] for i in range(1, 4)]
+                 + [{"attribute_id": "hutch-be-{}-orientation".format(loc)} for loc in ["top", "mid", "bot", "sam"]],
+        "personnel": [{"attribute_id": "personnel-poc-sci{}".format(i), "reporting_label": "Scientific POC {}".format(i)} for i in range(1, 4)],
+        "pcdssetup": [{"attribute_id": "pcdssetup-motors-setup-{}-purpose".format(i)} for i in range(1, 4)],
+    }
+    data = {"tabnames": sorted(tabs.keys()), "form_definitions": tabs, "enum_field_names": ["xraytech-tech-1", "xraytech-tech-2", "xraytech-tech-3"],
+            "proposals": {}, "status": [], "personnel": []}
+    for n in range(num_proposals):
+        proposalid = "L{}{:04d}".format(chr(ord('A') + n % 26), n)
+        instrument = INSTRUMENTS[n % len(INSTRUMENTS)]
+        start = "20{:02d}-{:02d}-{:02d} 09:00:00".format(18 + n % 5, 1 + n % 12, 1 + n % 28)
+        end = start.replace("09:00:00", "21:00:00")
+        attributes = {
+            "general": [{"id": d["attribute_id"], "val": "value {} {}".format(proposalid, i)} for i, d in enumerate(tabs["general"])],
+            "xraytech": [{"id": d["attribute_id"], "val": rnd.choice(XRAY_TECHNIQUES)} for d in tabs["xraytech"][:rnd.randint(1, 3)]],
+            "hutch": [{"id": d["attribute_id"], "val": str(rnd.randint(0, 3))} for d in tabs["hutch"] if not d["attribute_id"].endswith("orientation")]
+                     + [{"id": d["attribute_id"], "val": rnd.choice(["vertical", "horizontal"])} for d in tabs["hutch"] if d["attribute_id"].endswith("orientation")],
+            "personnel": [{"id": d["attribute_id"], "val": "poc{}@slac.stanford.edu".format(rnd.randint(1, 20))} for d in tabs["personnel"]],
+            "pcdssetup": [],
+        }
+        urawi = {
+            "info": {
+                "startDate": start,
+                "stopDate": end,
+                "instrument": instrument,
+                "proposalTitle": "Synthetic proposal {}".format(proposalid),
+                "proposalAbstract": "An abstract for {}".format(proposalid),
+                "spokesPerson": {"firstName": "First{}".format(n), "lastName": "Last{}".format(n), "email": "sp{}@example.com".format(n)},
+                "nonURAWI_proposal": False,
+                "approved": n % 4 != 3,
+            },
+            "contacts": {"point_of_contact": "poc{}@slac.stanford.edu".format(n % 20)},
+        }
+        experiment_name = "{}{}{}".format(instrument.lower(), proposalid.lower(), run[-2:])
+        data["proposals"][proposalid] = {"instrument": instrument, "attributes": attributes, "urawi": urawi, "experiment_name": experiment_name}
+        data["status"].append({"proposal_id": proposalid, "modified_by": "user{}".format(n % 7), "modified_time": start, "status": "Submitted"})
+        data["personnel"].append({"proposal_id": proposalid, "instrument": instrument, "startDate": start, "endDate": end, "poc": urawi["contacts"]["point_of_contact"]})
+    return data
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that the client can keep connections alive
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send(self, status, body=None):
+        content = json.dumps(body).encode("utf-8") if body is not None else b""
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, content = 304, b""
+        # Counted before anything is sent so that the counters are up to date once the client has the response.
+        self.server.mock._served(len(content), status)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if status in (200, 304):
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _dispatch(self, method):
+        mock = self.server.mock
+        parsed = urlparse(self.path)
+        # Blank values are kept; posting an empty val clears an attribute
+        query = {k: v[0] for k, v in parse_qs(parsed.query, keep_blank_values=True).items()}
+        form = {}
+        if method == "POST":
+            length = int(self.headers.get("Content-Length") or 0)
+            form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode("utf-8"), keep_blank_values=True).items()}
+        if mock.latency:
+            time.sleep(mock.latency * (0.5 + mock._random()))
+        if mock.accept_auth is not None and not mock.accept_auth(self.headers.get("Authorization")):
+            return self._send(401, {"error": "Unauthorized"})
+        if mock.error_rate and mock._random() < mock.error_rate:
+            return self._send(503, {"error": "Injected error"})
+        if "/ws/" not in parsed.path:
+            return self._send(404, {"error": "Not found"})
+        parts = parsed.path.split("/ws/", 1)[1].strip("/").split("/")
+        status, body = mock.handle(method, parts, query, form)
+        self._send(status, body)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+
+class MockQuestionnaireServer(object):
+    """
+    A local stand in for the questionnaire web service.
+    Authentication is not checked unless accept_auth is provided; use the client with use_kerberos=False and any user/password.
+
+    Parameters
+    ----------
+    runs: dict, optional
+        Run period name to the data from generateSyntheticRun. Defaults to a small run18
+
+    host: str, optional
+        The interface to listen on
+
+    port: int, optional
+        The port to listen on; 0 picks a free port
+
+    latency: float, optional
+        The average number of seconds each request is delayed by
+
+    error_rate: float, optional
+        The fraction of requests that fail with a 503
+
+    seed: int, optional
+        The random seed for the latency and the injected errors
+
+    accept_auth: callable, optional
+        Called with the Authorization header of each request; requests for which
+        this returns False fail with a 401. By default authentication is not checked
+    """
+    def __init__(self, runs=None, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, seed=0, accept_auth=None):
+        self.runs = runs if runs is not None else {"run18": generateSyntheticRun("run18")}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.accept_auth = accept_auth
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests_served = 0
+        self.bytes_served = 0
+        self.errors_served = 0
+        self.httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        '''The base URL to pass to the QuestionnaireClient'''
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}/questionnaire/".format(host, port)
+
+    def _random(self):
+        with self._lock:
+            return self._rnd.random()
+
+    def _served(self, size, status):
+        with self._lock:
+            self.requests_served += 1
+            self.bytes_served += size
+            if status >= 400:
+                self.errors_served += 1
+
+    def resetCounters(self):
+        with self._lock:
+            self.requests_served = self.bytes_served = self.errors_served = 0
+
+    def start(self):
+        '''Serve requests in a background thread'''
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="MockQuestionnaireServer")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _proposal(self, run, proposalid):
+        return self.runs.get(run, {}).get("proposals", {}).get(proposalid)
+
+    def handle(self, method, parts, query, form):
+        '''
+        Generate the response for a request; parts is the URL path after ws/ split on /
+        Returns a tuple of the HTTP status code and the JSON body.
+        '''
+        if parts[0] == "proposal" and len(parts) == 4 and parts[1] == "attribute":
+            run, proposalid = parts[2], parts[3]
+            proposal = self._proposal(run, proposalid)
+            if proposal is None:
+                return 404, {"error": "No such proposal"}
+            if method == "POST":
+                if "id" not in form or "val" not in form:
+                    return 400, {"error": "The id and val are required"}
+                with self._lock:
+                    tabname = form["id"].split("-")[0]
+                    attrs = proposal["attributes"].setdefault(tabname, [])
+                    for attr in attrs:
+                        if attr["id"] == form["id"]:
+                            attr["val"] = form["val"]
+                            break
+                    else:
+                        attrs.append({"id": form["id"], "val": form["val"]})
+                return 200, {"success": True}
+            return 200, proposal["attributes"]
+        if parts[0] != "questionnaire" or method != "GET":
+            return 404, {"error": "Not found"}
+        parts = parts[1:]
+        if parts == ["getURAWIProposalIds"]:
+            return 200, {p["experiment_name"]: proposalid for data in self.runs.values() for proposalid, p in data["proposals"].items()}
+        if parts == ["lookupByExperimentName"]:
+            for run, data in sorted(self.runs.items()):
+                for proposalid, p in data["proposals"].items():
+                    if p["experiment_name"] == query.get("experiment_name"):
+                        return 200, {"proposal_id": proposalid, "run_period": run}
+            return 200, {}
+        if len(parts) == 2 and parts[0] in ("experiments", "proposals_status", "proposals_personnel"):
+            data = self.runs.get(parts[1])
+            if data is None:
+                return 404, {"error": "No such run"}
+            if parts[0] == "experiments":
+                return 200, {"experiments": [{"proposal_id": proposalid, "instrument": p["instrument"]} for proposalid, p in sorted(data["proposals"].items())]}
+            if parts[0] == "proposals_status":
+                return 200, {"experiment_status": data["status"]}
+            return 200, {"proposals_personnel": data["personnel"]}
+        if len(parts) == 3 and parts[0] == "urawidata":
+            proposal = self._proposal(parts[1], parts[2])
+            if proposal is None:
+                return 404, {"error": "No such proposal"}
+            return 200, proposal["urawi"]
+        if len(parts) == 2 and parts[0] in self.runs:
+            data = self.runs[parts[0]]
+            if parts[1] == "tabnames":
+                return 200, data["tabnames"]
+            if parts[1] == "form_data_definitions":
+                return 200, data["form_definitions"].get(query.get("form_name"), [])
+            if parts[1] == "get_enum_field_names":
+                return 200, data["enum_field_names"]
+        return 404, {"error": "Not found"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic questionnaire data locally')
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--runs', nargs='+', default=["run18"], help="The run periods to generate.")
+    parser.add_argument('--proposals', type=int, default=100, help="The number of proposals per run.")
+    parser.add_argument('--attributes', type=int, default=50, help="The number of free form attributes per proposal.")
+    parser.add_argument('--latency', type=float, default=0.0, help="The average delay in seconds for each request.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="The fraction of requests that fail with a 503.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    runs = {run: generateSyntheticRun(run, args.proposals, args.attributes, seed=args.seed + i) for i, run in enumerate(args.runs)}
+    server = MockQuestionnaireServer(runs, host=args.host, port=args.port, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    print("Serving", ", ".join(args.runs), "at", server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
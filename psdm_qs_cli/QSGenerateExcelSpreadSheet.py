@@ -3,58 +3,95 @@
 We take a list of attributes in a file, (names with mappings) and generate a row per proposal and a column per attribute.
 '''
 
+import os
+import sys
 import argparse
 import json
+import heapq
 import logging
-from openpyxl import Workbook
-from openpyxl.styles import colors
-from openpyxl.styles import Font, Color
+from contextlib import nullcontext
 
 from psdm_qs_cli import QuestionnaireClient
+from psdm_qs_cli.QuestionnaireTransport import ReplayTransport
+from psdm_qs_cli.ConcurrencyLimiter import AIMDConcurrencyLimiter
+from psdm_qs_cli.QuestionnaireMetrics import QuestionnaireMetrics, sinkForPath
+from psdm_qs_cli.ExportCheckpoint import ExportCheckpoint
+from psdm_qs_cli.ExportProfiler import ExportProfiler, addProfilingArguments
 
 logging.basicConfig(level=logging.DEBUG)
 
 logger = logging.getLogger(__name__)
 
-def generateExcelSpreadSheetForRun(qs, run, attributes_file, excelFilePath):
+def generateExcelSpreadSheetForRun(qs, run, attributes_file, excelFilePath, workers=1, instruments=None, proposal_ids=None, approvedOnly=False, resume=False):
     '''
     Generate a Excel spreadsheet with data from a run.
     :param: qs - A Questionnaire client
     :run: The number number/name; this is a string like run15 which is what the questionnaire uses in its URL
+    :workers: - The number of concurrent requests used to fetch the proposal details.
+    :instruments: - Only export proposals for these instruments.
+    :proposal_ids: - Only export these proposals; glob patterns like LR* are allowed.
+    :approvedOnly: - Only export approved proposals.
+    :resume: - Skip the proposals completed by a previous interrupted attempt; see ExportCheckpoint.
+    Returns the proposals that could not be fetched (proposal id to the exception); these are left out of the spreadsheet.
     '''
+    # openpyxl is slow to import and not a dependency of the package; it is only needed once a spreadsheet is written.
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import colors
+    from openpyxl.styles import Font
+
     column2Names = [('proposal_id', "Proposal")]
     with open(attributes_file, 'r') as f:
         attrs = json.load(f)
         column2Names.extend((x["attr"], x["label"]) for x in attrs)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = run
+    # A write-only workbook streams the rows to disk rather than keeping a cell object for every value.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(run)
     fontStyle = Font(name="Times New Roman", size=12, color=colors.BLACK)
 
     # Generate the header column using the 2 element in the column2Names tuples
-    for clnum in range(len(column2Names)):
-        cl = ws.cell(row=1, column=clnum+1, value=column2Names[clnum][1])
+    header = []
+    for ckey, clabel in column2Names:
+        cl = WriteOnlyCell(ws, value=clabel)
         cl.font = fontStyle
+        header.append(cl)
+    ws.append(header)
+    columnKeys = [ckey for ckey, _ in column2Names]
+
+    # Get a list of proposals; the filters are applied before any details are fetched.
+    proposals = qs.filterProposals(qs.getProposalsListForRun(run), instruments, proposal_ids)
+    failures = {}
+    checkpoint = ExportCheckpoint(excelFilePath, {"exporter": "excel", "run": run, "columns": columnKeys, "approvedOnly": approvedOnly})
+    with checkpoint:
+        completed = checkpoint.start(resume)
+        if completed:
+            print("Resuming with", len(completed), "proposals from", checkpoint.path)
+        completedRows = sorted((completed[proposalid] for proposalid in proposals if proposalid in completed), key=lambda row: row['proposal_id'])
+        remaining = sorted(proposalid for proposalid in proposals if proposalid not in completed)
+        print("Getting details for", len(remaining), "of", len(proposals), "proposals")
+
+        def fetchedRows():
+            for record in qs.iterProposalDetails(run, remaining, workers=workers, ordered=True, proposals=proposals, failures=failures, fields=columnKeys, approved_only=approvedOnly):
+                row = {ckey: record.get(ckey) for ckey in columnKeys}
+                checkpoint.add(row)
+                yield row
 
-    # Get a list of proposals
-    proposals = qs.getProposalsListForRun(run)
-    rowNum = 1
-    for proposalid in sorted(proposals.keys()):
-        print("Getting details for proposal ", proposalid)
-        proposalDetails = qs.getProposalDetailsForRun(run, proposalid)
-        # Add the details of each proposal to the information obtained from the proposal list call.
-        proposals[proposalid].update(proposalDetails)
-        for clnum in range(len(column2Names)):
-            ckey = column2Names[clnum][0]
-            if ckey in proposals[proposalid]:
-                _ = ws.cell(row=rowNum+1, column=clnum+1, value=proposals[proposalid][ckey])
-            else:
-                _ = ws.cell(row=rowNum+1, column=clnum+1, value='')
-        rowNum = rowNum + 1
+        # The rows are written in proposal order as the details are fetched; only the calls needed for the columns are made.
+        for row in heapq.merge(completedRows, fetchedRows(), key=lambda row: row['proposal_id']):
+            # Missing values are left as empty cells
+            ws.append([row[ckey] for ckey in columnKeys])
+    for proposalid, error in failures.items():
+        print("Failed to get details for proposal ", proposalid, error)
 
     wb.save(excelFilePath)
+    if failures:
+        # Keep the completed proposals so that a rerun with resume only fetches the failed ones.
+        print("Kept the checkpoint", checkpoint.path, "; rerun with --resume to fetch the failed proposals")
+    else:
+        checkpoint.finish()
     print("Saved data into", excelFilePath)
+    return failures
 
 
 def main():
@@ -63,13 +100,39 @@ def main():
     parser.add_argument('--no_kerberos', action="store_false")
     parser.add_argument('--user')
     parser.add_argument('--password')
+    parser.add_argument('--workers', type=int, default=4, help="The number of proposals to fetch concurrently.")
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser("~"), ".cache", "psdm_qs_cli"), help="Cache the run period metadata in this folder.")
+    parser.add_argument('--no-cache', action="store_true", help="Do not use the on-disk cache.")
+    parser.add_argument('--record-to', help="Record every questionnaire response into this snapshot folder.")
+    parser.add_argument('--replay-from', help="Replay the questionnaire responses from this snapshot folder or archive; no network access is made.")
+    parser.add_argument('--instruments', nargs='+', help="Only export proposals for these instruments, for example, XPP XCS.")
+    parser.add_argument('--proposals', nargs='+', help="Only export these proposals; glob patterns like LR* are allowed.")
+    parser.add_argument('--approved-only', action="store_true", help="Only export approved proposals.")
+    parser.add_argument('--metrics-out', help="Write a summary of the requests made at the end; - logs it, a *.prom file is in the Prometheus text format, anything else is JSON.")
+    parser.add_argument('--resume', action="store_true", help="Resume an interrupted export; only the proposals not completed by the previous attempt are fetched.")
+    parser.add_argument('--timeout', type=float, default=60, help="The read timeout in seconds for each request.")
+    parser.add_argument('--retries', type=int, default=3, help="The number of times a failed GET is retried with a jittered exponential backoff.")
+    parser.add_argument('--adaptive-concurrency', action="store_true", help="Adapt the number of requests in flight, up to --workers, to the server's latency and errors.")
+    addProfilingArguments(parser)
     parser.add_argument('run')
     parser.add_argument('attributes_file', help='A JSON file with an array of dicts; each of which has a attrname and a label.')
     parser.add_argument('excelFilePath')
     args = parser.parse_args()
 
-    qs = QuestionnaireClient(args.questionnaire_url, args.no_kerberos, user=args.user, pw=args.password)
-    generateExcelSpreadSheetForRun(qs, args.run, args.attributes_file, args.excelFilePath)
+    qs = QuestionnaireClient(args.questionnaire_url, args.no_kerberos, user=args.user, pw=args.password, pool_maxsize=max(10, 2*args.workers), cache_dir=None if args.no_cache else args.cache_dir,
+                             transport=ReplayTransport(args.replay_from) if args.replay_from else None, record_to=args.record_to,
+                             metrics=QuestionnaireMetrics([sinkForPath(args.metrics_out)] if args.metrics_out else []) if args.metrics_out or args.profile or args.trace_memory else None,
+                             timeout=(10, args.timeout), retries=args.retries,
+                             limiter=AIMDConcurrencyLimiter(initial=min(4, args.workers), maximum=args.workers) if args.adaptive_concurrency else None)
+    with ExportProfiler(args.profile, args.profile_out, args.trace_memory, qs.metrics, sort=args.profile_sort) if args.profile or args.trace_memory else nullcontext():
+        failures = generateExcelSpreadSheetForRun(qs, args.run, args.attributes_file, args.excelFilePath, workers=args.workers,
+                                                  instruments=args.instruments, proposal_ids=args.proposals, approvedOnly=args.approved_only,
+                                                  resume=args.resume)
+    if qs.metrics is not None:
+        qs.metrics.emit()
+    if failures:
+        # The spreadsheet has been saved without these proposals; let the caller know it is incomplete.
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -2,42 +2,230 @@
 '''Use the questionnaire client to save all the data locally to a JSON document
 '''
 
+import os
+import sys
 import argparse
 import json
+import hashlib
+import logging
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 from psdm_qs_cli import QuestionnaireClient
+from psdm_qs_cli.QuestionnaireTransport import ReplayTransport
+from psdm_qs_cli.ConcurrencyLimiter import AIMDConcurrencyLimiter
+from psdm_qs_cli.QuestionnaireMetrics import QuestionnaireMetrics, sinkForPath
+from psdm_qs_cli.ExportCheckpoint import ExportCheckpoint
+from psdm_qs_cli.ExportProfiler import ExportProfiler, addProfilingArguments
 
+logger = logging.getLogger(__name__)
 
-def generateJSONDocumentForRun(qs, run, useLabels, jsonFilePath):
+
+def statusFingerprints(status):
+    '''
+    Reduce the output of getProposalsStatusForRun to a fingerprint per proposal.
+    The fingerprint changes whenever anyone changes anything in the proposal.
+    :param: status - The status feed; either a list of dicts with a proposal_id or a dict keyed by proposal id
+    '''
+    byProposal = {}
+    if isinstance(status, dict):
+        byProposal = {k: [v] for k, v in status.items()}
+    else:
+        for entry in status:
+            byProposal.setdefault(entry.get('proposal_id'), []).append(entry)
+    return {proposalid: hashlib.sha1(json.dumps(entries, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+            for proposalid, entries in byProposal.items() if proposalid is not None}
+
+
+def _loadPreviousExport(run, useLabels, jsonFilePath):
+    '''Load the previous export and its state; returns (None, {}) if these cannot be used for an incremental export'''
+    try:
+        with open(jsonFilePath, 'r') as f:
+            previous = json.load(f)
+        with open(jsonFilePath + ".state", 'r') as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None, {}
+    if state.get("run") != run or state.get("useLabels") != useLabels:
+        return None, {}
+    return previous, state.get("fingerprints", {})
+
+
+def generateJSONDocumentForRun(qs, run, useLabels, jsonFilePath, workers=1, incremental=False, instruments=None, proposal_ids=None, approvedOnly=False, resume=False):
     '''
     Generate a JSON document with data from a run.
     :param: qs - A Questionnaire client
     :run: The number number/name; this is a string like run15 which is what the questionnaire uses in its URL
     :useLabels: - Use the labels as the attribute names.
+    :workers: - The number of concurrent requests used to fetch the proposal details.
+    :incremental: - Only fetch the details of proposals that have changed since the previous export to jsonFilePath.
+    :instruments: - Only export proposals for these instruments.
+    :proposal_ids: - Only export these proposals; glob patterns like LR* are allowed.
+    :approvedOnly: - Only export approved proposals.
+    :resume: - Skip the proposals completed by a previous interrupted attempt; see ExportCheckpoint.
+    Returns the proposals that could not be fetched (proposal id to the exception); these are left out of the document.
     '''
+    previous, previousFingerprints, fingerprints = None, {}, {}
+    if incremental:
+        fingerprints = statusFingerprints(qs.getProposalsStatusForRun(run))
+        previous, previousFingerprints = _loadPreviousExport(run, useLabels, jsonFilePath)
+        if previous is None:
+            print("No usable previous export in", jsonFilePath, "; exporting everything")
 
-    nameMappings = qs.formLabelMappings(run)
-
-    # Get a list of proposals
-    proposals = qs.getProposalsListForRun(run)
-    for proposalid in proposals.keys():
-        print("Getting details for proposal ", proposalid)
-        proposalDetails = qs.getProposalDetailsForRun(run, proposalid)
-        # Add the details of each proposal to the information obtained from the proposal list call.
-        if useLabels:
-            mappedProposalDetails = {}
-            for k, v in proposalDetails.items():
-                if k in nameMappings:
-                    mappedProposalDetails[nameMappings[k]] = v
-                else:
-                    mappedProposalDetails[k] = v
-                proposals[proposalid].update(mappedProposalDetails)
+    # The form definitions are only needed for the labels; fetch them while the proposals are being fetched.
+    checkpoint = ExportCheckpoint(jsonFilePath, {"exporter": "json", "run": run, "approvedOnly": approvedOnly})
+    with checkpoint, ThreadPoolExecutor(max_workers=1) as executor:
+        completed = checkpoint.start(resume)
+        if completed:
+            print("Resuming with", len(completed), "proposals from", checkpoint.path)
+        mapperFuture = executor.submit(qs.getLabelMapper, run) if useLabels else None
+
+        # Get a list of proposals; the filters are applied before any details are fetched.
+        proposals = qs.filterProposals(qs.getProposalsListForRun(run), instruments, proposal_ids)
+        if previous is None:
+            toFetch = list(proposals.keys())
+        else:
+            toFetch = [proposalid for proposalid in proposals.keys()
+                       if proposalid not in previous
+                       or proposalid not in fingerprints
+                       or fingerprints[proposalid] != previousFingerprints.get(proposalid)]
+            for proposalid in proposals.keys():
+                if proposalid not in toFetch:
+                    proposals[proposalid] = previous[proposalid]
+        fetched = {proposalid: completed[proposalid] for proposalid in toFetch if proposalid in completed}
+        remaining = [proposalid for proposalid in toFetch if proposalid not in fetched]
+        print("Getting details for", len(remaining), "of", len(proposals), "proposals")
+        failures = {}
+        for record in qs.iterProposalDetails(run, remaining, workers=workers, proposals=proposals, failures=failures, approved_only=approvedOnly):
+            checkpoint.add(record)
+            fetched[record['proposal_id']] = record
+        labelMapper = mapperFuture.result() if useLabels else None
+
+    for proposalid, error in failures.items():
+        print("Failed to get details for proposal ", proposalid, error)
+    for proposalid in toFetch:
+        if proposalid in fetched:
+            continue
+        if proposalid in failures and previous is not None and proposalid in previous:
+            # Keep the last good data; the old fingerprint no longer matches so the next export retries it
+            proposals[proposalid] = previous[proposalid]
+            if proposalid in previousFingerprints:
+                fingerprints[proposalid] = previousFingerprints[proposalid]
+            else:
+                fingerprints.pop(proposalid, None)
         else:
-            proposals[proposalid].update(proposalDetails)
+            # Either failed or not approved
+            del proposals[proposalid]
+            fingerprints.pop(proposalid, None)
+    for proposalid, record in fetched.items():
+        proposals[proposalid] = qs.applyLabelMappings(record, labelMapper) if useLabels else record
 
     with open(jsonFilePath, 'w') as f:
         json.dump(proposals, f)
+    if incremental:
+        with open(jsonFilePath + ".state", 'w') as f:
+            json.dump({"run": run, "useLabels": useLabels, "fingerprints": fingerprints}, f)
+    if failures:
+        # Keep the completed proposals so that a rerun with resume only fetches the failed ones.
+        print("Kept the checkpoint", checkpoint.path, "; rerun with --resume to fetch the failed proposals")
+    else:
+        checkpoint.finish()
     print("Saved data into", jsonFilePath)
+    return failures
+
+
+def _truncatePartialLine(path):
+    '''Drop a partially written last line (from an interrupted export) so that the file can be appended to'''
+    with open(path, 'rb+') as f:
+        end = pos = f.seek(0, os.SEEK_END)
+        # Search backwards for the end of the last complete line
+        while pos > 0:
+            step = min(pos, 64*1024)
+            f.seek(pos - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline >= 0:
+                pos = pos - step + newline + 1
+                break
+            pos = pos - step
+        if pos < end:
+            logger.warning("Dropping the partially written last line in %s", path)
+            f.truncate(pos)
+
+
+def generateNDJSONDocumentForRun(qs, run, useLabels, jsonFilePath, workers=1, flushEvery=10, instruments=None, proposal_ids=None, approvedOnly=False, resume=False):
+    '''
+    Stream the data from a run into a newline delimited JSON document; one proposal per line.
+    Each proposal is written as soon as its details are fetched so memory use does not grow with the run
+    and the proposals written before a crash are not lost. Use readNDJSON to read the document back.
+    :param: qs - A Questionnaire client
+    :run: The number number/name; this is a string like run15 which is what the questionnaire uses in its URL
+    :useLabels: - Use the labels as the attribute names.
+    :workers: - The number of concurrent requests used to fetch the proposal details.
+    :flushEvery: - Flush the output file after this many proposals; 0 only flushes at the end.
+    :instruments: - Only export proposals for these instruments.
+    :proposal_ids: - Only export these proposals; glob patterns like LR* are allowed.
+    :approvedOnly: - Only export approved proposals.
+    :resume: - Keep the proposals already in jsonFilePath from a previous interrupted attempt of the same export and only fetch the rest.
+    Returns the proposals that could not be fetched (proposal id to the exception).
+    '''
+    # The document is its own checkpoint; the parameters of the export are kept in a .state sidecar so that resuming
+    # does not mix the proposals from different exports.
+    params = json.loads(json.dumps({"format": "ndjson", "run": run, "useLabels": useLabels, "instruments": instruments,
+                                    "proposal_ids": proposal_ids, "approvedOnly": approvedOnly}))
+    seen, resuming = set(), False
+    if resume and os.path.exists(jsonFilePath):
+        try:
+            with open(jsonFilePath + ".state", 'r') as f:
+                resuming = json.load(f) == params
+        except (IOError, OSError, ValueError):
+            pass
+        if resuming:
+            _truncatePartialLine(jsonFilePath)
+            seen = set(record.get('proposal_id') for record in readNDJSON(jsonFilePath))
+            print("Resuming with", len(seen), "proposals from", jsonFilePath)
+        else:
+            logger.warning("%s is not from the same export; starting over", jsonFilePath)
+    if not resuming:
+        with open(jsonFilePath + ".state", 'w') as f:
+            json.dump(params, f)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        mapperFuture = executor.submit(qs.getLabelMapper, run) if useLabels else None
+        proposals = qs.filterProposals(qs.getProposalsListForRun(run), instruments, proposal_ids)
+        for proposalid in seen:
+            proposals.pop(proposalid, None)
+        print("Getting details for", len(proposals), "proposals")
+        failures = {}
+        written = len(seen)
+        # Appending keeps the proposals already saved even if this attempt dies too.
+        with open(jsonFilePath, 'a' if resuming else 'w') as f:
+            for record in qs.iterProposalDetails(run, workers=workers, proposals=proposals, failures=failures, approved_only=approvedOnly):
+                if useLabels:
+                    record = qs.applyLabelMappings(record, mapperFuture.result())
+                f.write(json.dumps(record) + "\n")
+                written = written + 1
+                if flushEvery and written % flushEvery == 0:
+                    f.flush()
+    for proposalid, error in failures.items():
+        print("Failed to get details for proposal ", proposalid, error)
+    print("Saved", written, "proposals into", jsonFilePath)
+    return failures
+
+
+def readNDJSON(jsonFilePath):
+    '''
+    Lazily iterate over the proposals in a newline delimited JSON document from generateNDJSONDocumentForRun.
+    A partially written last line (from an interrupted export) is skipped.
+    '''
+    with open(jsonFilePath, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                if line.endswith("\n"):
+                    raise
+                logger.warning("Skipping the partially written last line in %s", jsonFilePath)
 
 
 def main():
@@ -45,12 +233,50 @@ def main():
     parser.add_argument('--questionnaire_url', default="https://pswww.slac.stanford.edu/ws-kerb/questionnaire")
     parser.add_argument('--useLabels', action="store_true", help="Use the questionnaire labels as the attribute names.")
     parser.add_argument('--no_kerberos', action="store_false")
+    parser.add_argument('--workers', type=int, default=4, help="The number of proposals to fetch concurrently.")
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser("~"), ".cache", "psdm_qs_cli"), help="Cache the run period metadata in this folder.")
+    parser.add_argument('--no-cache', action="store_true", help="Do not use the on-disk cache.")
+    parser.add_argument('--record-to', help="Record every questionnaire response into this snapshot folder.")
+    parser.add_argument('--replay-from', help="Replay the questionnaire responses from this snapshot folder or archive; no network access is made.")
+    parser.add_argument('--incremental', action="store_true", help="Only refetch proposals whose status changed since the previous export to jsonFilePath.")
+    parser.add_argument('--format', choices=["json", "ndjson"], default="json", help="ndjson streams one proposal per line as it is fetched.")
+    parser.add_argument('--flush-every', type=int, default=10, help="With --format ndjson, flush the output after this many proposals; 0 only flushes at the end.")
+    parser.add_argument('--instruments', nargs='+', help="Only export proposals for these instruments, for example, XPP XCS.")
+    parser.add_argument('--proposals', nargs='+', help="Only export these proposals; glob patterns like LR* are allowed.")
+    parser.add_argument('--approved-only', action="store_true", help="Only export approved proposals.")
+    parser.add_argument('--metrics-out', help="Write a summary of the requests made at the end; - logs it, a *.prom file is in the Prometheus text format, anything else is JSON.")
+    parser.add_argument('--resume', action="store_true", help="Resume an interrupted export; only the proposals not completed by the previous attempt are fetched.")
+    parser.add_argument('--timeout', type=float, default=60, help="The read timeout in seconds for each request.")
+    parser.add_argument('--retries', type=int, default=3, help="The number of times a failed GET is retried with a jittered exponential backoff.")
+    parser.add_argument('--adaptive-concurrency', action="store_true", help="Adapt the number of requests in flight, up to --workers, to the server's latency and errors.")
+    addProfilingArguments(parser)
     parser.add_argument('run')
     parser.add_argument('jsonFilePath')
     args = parser.parse_args()
+    if args.incremental and args.format == "ndjson":
+        parser.error("--incremental is only supported with --format json")
+    if args.flush_every < 0:
+        parser.error("--flush-every cannot be negative")
 
-    qs = QuestionnaireClient(args.questionnaire_url, args.no_kerberos)
-    generateJSONDocumentForRun(qs, args.run, args.useLabels, args.jsonFilePath)
+    qs = QuestionnaireClient(args.questionnaire_url, args.no_kerberos, pool_maxsize=max(10, 2*args.workers), cache_dir=None if args.no_cache else args.cache_dir,
+                             transport=ReplayTransport(args.replay_from) if args.replay_from else None, record_to=args.record_to,
+                             metrics=QuestionnaireMetrics([sinkForPath(args.metrics_out)] if args.metrics_out else []) if args.metrics_out or args.profile or args.trace_memory else None,
+                             timeout=(10, args.timeout), retries=args.retries,
+                             limiter=AIMDConcurrencyLimiter(initial=min(4, args.workers), maximum=args.workers) if args.adaptive_concurrency else None)
+    with ExportProfiler(args.profile, args.profile_out, args.trace_memory, qs.metrics, sort=args.profile_sort) if args.profile or args.trace_memory else nullcontext():
+        if args.format == "ndjson":
+            failures = generateNDJSONDocumentForRun(qs, args.run, args.useLabels, args.jsonFilePath, workers=args.workers, flushEvery=args.flush_every,
+                                                    instruments=args.instruments, proposal_ids=args.proposals, approvedOnly=args.approved_only,
+                                                    resume=args.resume)
+        else:
+            failures = generateJSONDocumentForRun(qs, args.run, args.useLabels, args.jsonFilePath, workers=args.workers, incremental=args.incremental,
+                                                  instruments=args.instruments, proposal_ids=args.proposals, approvedOnly=args.approved_only,
+                                                  resume=args.resume)
+    if qs.metrics is not None:
+        qs.metrics.emit()
+    if failures:
+        # The document has been saved without these proposals; let the caller know it is incomplete.
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''Sync questionnaire data into a local SQLite mirror and query it without touching the network.
+'''
+
+import os
+import sys
+import argparse
+import json
+
+from psdm_qs_cli.QuestionnaireMirror import QuestionnaireMirror
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mirror the questionnaire into a local SQLite database and query it')
+    parser.add_argument('--db', default=os.path.join(os.path.expanduser("~"), ".cache", "psdm_qs_cli", "mirror.sqlite"), help="The SQLite database.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    syncparser = subparsers.add_parser('sync', help="Sync one or more run periods from the questionnaire.")
+    syncparser.add_argument('--questionnaire_url', default="https://pswww.slac.stanford.edu/ws-kerb/questionnaire")
+    syncparser.add_argument('--no_kerberos', action="store_false")
+    syncparser.add_argument('--user')
+    syncparser.add_argument('--password')
+    syncparser.add_argument('--workers', type=int, default=4, help="The number of proposals to fetch concurrently.")
+    syncparser.add_argument('runs', nargs='+')
+
+    queryparser = subparsers.add_parser('query', help="Find proposals by attribute in the mirror.")
+    queryparser.add_argument('--runs', nargs='*', help="Only these run periods.")
+    queryparser.add_argument('--instruments', nargs='*', help="Only these instruments.")
+    queryparser.add_argument('--value', help="Only attributes with this value.")
+    queryparser.add_argument('attribute_id', help="The attribute id; use % as a wildcard.")
+
+    subparsers.add_parser('runs', help="List the run periods in the mirror.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(args.db))):
+        os.makedirs(os.path.dirname(os.path.abspath(args.db)))
+    with QuestionnaireMirror(args.db) as mirror:
+        if args.command == 'sync':
+            from psdm_qs_cli import QuestionnaireClient
+            qs = QuestionnaireClient(args.questionnaire_url, args.no_kerberos, user=args.user, pw=args.password, pool_maxsize=max(10, 2*args.workers))
+            failed = False
+            for run in args.runs:
+                print("Syncing", run)
+                failures = mirror.sync(qs, run, workers=args.workers)
+                for proposalid, error in failures.items():
+                    print("Failed to get details for proposal ", proposalid, error)
+                failed = failed or bool(failures)
+            if failed:
+                sys.exit(1)
+        elif args.command == 'query':
+            for row in mirror.findProposals(args.attribute_id, args.value, runs=args.runs, instruments=args.instruments):
+                print(json.dumps(row))
+        elif args.command == 'runs':
+            for run in mirror.runs():
+                print(run)
+        else:
+            parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
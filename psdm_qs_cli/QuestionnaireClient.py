@@ -3,25 +3,167 @@
 Various web service calls to the Questionnaire backend to get data for reporting.
 '''
 import json
-import requests
 import datetime
 import logging
+import fnmatch
 import getpass
-from functools import partial
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from six.moves import queue
 from six.moves.urllib.parse import urlparse
 
+from .ResponseCache import ResponseCache
+from .MetadataCache import MetadataCache
+from .LabelMapper import LabelMapper
+from .QuestionnaireTransport import HTTPTransport, RecordingTransport, RetryingTransport, CachingTransport
+from .QuestionnaireMetrics import MetricsTransport
+from .KerberosAuth import sharedKerberosAuthProvider
+
 logger = logging.getLogger(__name__)
 
-try:
-    from krtc import KerberosTicket
-except ImportError:
-    KerberosTicket = None
-    logger.warning('krtc not installed: Kerberos ticket-based authentication '
-                   'unavailable.')
 
+class QuestionnaireResponseProcessor(object):
+    """
+    The post-processing of the Questionnaire web service responses.
+    This is shared by the blocking QuestionnaireClient and the asyncio based
+    AsyncQuestionnaireClient; neither of these methods touch the network.
+    """
+    kerb_url = 'https://pswww.slac.stanford.edu/ws-kerb/questionnaire/'
+    wsauth_url = "https://pswww.slac.stanford.edu/ws-auth/questionnaire/"
+    # The proposal detail fields that come from the urawidata call; everything else comes from the attribute call.
+    urawi_fields = frozenset(['StartDate', 'EndDate', 'instrument', 'urawi_poc', 'title', 'abstract', 'Spokesperson First',
+                              'Spokesperson Last', 'Spokesperson Email', 'nonURAWI_proposal', 'Approved'])
+    # The fields derived from the hutch attributes
+    be_fields = frozenset(['Be-TOP', 'Be-MID', 'Be-BTM', 'Be-AIR', 'Be-All Beryllium Lens Stack Recipes'])
+    # The fields that need neither call
+    id_fields = frozenset(['proposal_id', 'Proposal', 'Instrument'])
+
+    def _detailsNeeded(self, fields):
+        '''Which of the attribute call, the urawidata call and the Be lens summaries are needed for the requested fields'''
+        if fields is None:
+            return True, True, True
+        fields = set(fields)
+        needAttributes = bool(fields - self.urawi_fields - self.id_fields)
+        needURAWI = bool(fields & self.urawi_fields)
+        needBe = bool(fields & self.be_fields)
+        return needAttributes, needURAWI, needBe
 
-class QuestionnaireClient:
+    def _isApproved(self, approved):
+        '''Interpret the URAWI approved flag; this may be a boolean, a number or a string'''
+        if isinstance(approved, str):
+            return approved.strip().lower() not in ("", "0", "false", "no", "n")
+        return bool(approved)
+
+    def _processProposalsList(self, experiments):
+        # experiments is a list of dicts with instrument and proposal_id
+        proposals = {}
+        for experiment in experiments["experiments"]:
+            proposals[experiment['proposal_id']] = {'Instrument': experiment['instrument'], 'proposal_id': experiment['proposal_id']}
+        return proposals
+
+    def _updateIfExists(self, ret, srcdata, srcField, destName):
+        '''Update ret if and only if the sequence of fields exists in the src data
+        :param: ret - The return dict to update
+        :param: srcdata - The source data as a dict
+        :param: srcField - The srcField in canonical format - for example, contacts.point_of_contact
+        :param: destName - The name of the field in ret. So we can take contacts.point_of_contact and create a POC field..
+        '''
+        data = srcdata
+        for field in srcField.split("."):
+            if field not in data:
+                return
+            else:
+                data =  data[field]
+        ret[destName] = data
+
+    def _processProposalAttributes(self, ret, proposalData, beSummaries=True):
+        '''Add the attribute values and the derived Beryllium lens summaries to ret
+        :param: ret - The return dict to update
+        :param: proposalData - The response from the ws/proposal/attribute call
+        :param: beSummaries - Generate the Beryllium lens summaries
+        '''
+        # proposalData is a dict with list of dicts for the values
+        # We want the id and the val for the final dicts.
+        ret.update({x['id'] : x['val'] for x in [item for sublist in proposalData.values() for item in sublist]})
+        if not beSummaries:
+            return
+        # Generate Beryllium lens summaries for Daniel
+        hzvr = {'vertical': 'VERT', 'horizontal' : 'HORZ'}
+        for belocid, repid in {"hutch-be-top-d": "Be-TOP",  "hutch-be-mid-d": "Be-MID", "hutch-be-bot-d": "Be-BTM", "hutch-be-sam-d": "Be-AIR"}.items():
+            tpls = sorted([(c['id'].split("-")[3].replace("d1", "1D").replace("d2", "2D"), c['id'].split("-")[4], "x", c['val']) for c in proposalData.get('hutch', []) if c['id'].startswith(belocid) and int(c['val'])], key=lambda x : (x[0], int(x[1])))
+            if tpls:
+                h_or_v = "".join([hzvr.get(x['val'], 'VERT/HORZ') for x in proposalData['hutch'] if x['id'] == belocid.replace("-d", "-orientation")])
+                tpls = [x + (h_or_v,) if x[0]=='1D' else x for x in tpls]
+                ret[repid] = "  ".join(("".join(_) for _ in tpls))
+        combined_be = "\n".join(["{}:{}".format(fnl_be_attr, ret[fnl_be_attr]) for fnl_be_attr in ["Be-TOP", "Be-MID", "Be-BTM", "Be-AIR"] if fnl_be_attr in ret])
+        if combined_be:
+            ret["Be-All Beryllium Lens Stack Recipes"] = combined_be
+
+    def _processURAWIData(self, ret, urawiData):
+        '''Add the URAWI information (dates, title, spokesperson etc) to ret
+        :param: ret - The return dict to update
+        :param: urawiData - The response from the ws/questionnaire/urawidata call
+        '''
+        if urawiData['info']['startDate']:
+            ret.update({'StartDate': urawiData['info']['startDate']})
+        if urawiData['info']['stopDate']:
+            ret.update({'EndDate': urawiData['info']['stopDate']})
+        ret.update({"instrument": urawiData["info"]["instrument"]})
+        self._updateIfExists(ret, urawiData, "contacts.point_of_contact", "urawi_poc")
+        self._updateIfExists(ret, urawiData, "info.proposalTitle", "title")
+        self._updateIfExists(ret, urawiData, "info.proposalAbstract", "abstract")
+        self._updateIfExists(ret, urawiData, "info.spokesPerson.firstName", "Spokesperson First")
+        self._updateIfExists(ret, urawiData, "info.spokesPerson.lastName", "Spokesperson Last")
+        self._updateIfExists(ret, urawiData, "info.spokesPerson.email", "Spokesperson Email")
+        self._updateIfExists(ret, urawiData, "info.nonURAWI_proposal", "nonURAWI_proposal")
+        self._updateIfExists(ret, urawiData, "info.approved", "Approved")
+
+    def _combineProposalDetails(self, proposalid, proposalData, urawiData, beSummaries=True):
+        '''Combine the responses of the attribute and the urawidata calls; either of these may be None if they were not needed'''
+        ret = {}
+        ret['proposal_id'] = proposalid
+        ret['Proposal'] = proposalid
+        if proposalData is not None:
+            self._processProposalAttributes(ret, proposalData, beSummaries)
+        if urawiData is not None:
+            self._processURAWIData(ret, urawiData)
+        if 'personnel-poc-sci1' in ret:
+            ret["POC"] = ret['personnel-poc-sci1']
+        return ret
+
+    def _processFormDefinitions(self, nameMappings, formDefinitions):
+        '''Add the reporting labels for one form tab to nameMappings
+        :param: nameMappings - The attribute name to reporting label dict to update
+        :param: formDefinitions - The response from the form_data_definitions call
+        '''
+        for formDefinition in formDefinitions:
+            if 'reporting_label' in formDefinition:
+                nameMappings[formDefinition['attribute_id']] = formDefinition['reporting_label']
+            else:
+                if 'quantity' in  formDefinition and int(formDefinition['quantity']) > 1:
+                    nameMappings[formDefinition['attribute_id']] = formDefinition['attribute_id'][:(formDefinition['attribute_id'].rfind("_")-1)]
+
+    def _processPersonnel(self, datas):
+        '''Add the days to the start and to the end of the experiment to the personnel data
+        :param: datas - The proposals_personnel list from the proposals_personnel call
+        '''
+        now = datetime.datetime.now()
+        for data in datas:
+            if data['startDate'] and data['endDate']:
+                stdate  = datetime.datetime.strptime(data['startDate'], '%Y-%m-%d %H:%M:%S')
+                enddate = datetime.datetime.strptime(data['endDate'],   '%Y-%m-%d %H:%M:%S')
+                data['daysToStart'] = (stdate  - now).days
+                data['daysToEnd']   = (enddate - now).days
+                logger.debug("Start date %s End date %s daysToStart %s daysToEnd %s", data['startDate'], data['endDate'], data['daysToStart'], data['daysToEnd'])
+            else:
+                data['daysToStart'] = 0
+                data['daysToEnd']   = 0
+        return datas
+
+
+class QuestionnaireClient(QuestionnaireResponseProcessor):
     """
     Interface to the LCLS Questionnaire
 
@@ -41,28 +183,160 @@ class QuestionnaireClient:
     pw = str, optional
         A password for ws_auth sign-in. If not provided a password will be
         requested
-    """
-    kerb_url = 'https://pswww.slac.stanford.edu/ws-kerb/questionnaire/'
-    wsauth_url = "https://pswww.slac.stanford.edu/ws-auth/questionnaire/"
 
-    def __init__(self, url=None, use_kerberos=True, user=None, pw=None):
-        if use_kerberos:
-            if KerberosTicket is None:
-                raise RuntimeError('Kerberos-based authentication unavailable.  '
-                                   'Please install krtc.')
+    pool_connections: int, optional
+        The number of per-host connection pools to cache in the session
+
+    pool_maxsize: int, optional
+        The maximum number of connections kept alive to a single host
+
+    pool_block: bool, optional
+        Block when all connections to a host are in use rather than opening a
+        new, unpooled connection
+
+    keep_alive: bool, optional
+        Reuse connections between requests. If False each request asks the
+        server to close the connection once done
+
+    cache_dir: str, optional
+        Cache the slow changing run period metadata (tab names, form definitions etc)
+        in this folder. If left as None nothing is cached on disk
+
+    cache_ttls: list, optional
+        A list of (url fragment, seconds) pairs for the on-disk cache; see ResponseCache
+
+    cache_max_size: int, optional
+        The maximum size in bytes of the on-disk cache
+
+    metadata_cache_size: int, optional
+        The number of run scoped metadata results (form label mappings, enumerations)
+        kept in memory. 0 disables the in-memory cache
+
+    metadata_cache_ttl: float, optional
+        The number of seconds the in-memory run scoped metadata is valid for
+
+    transport: object, optional
+        Make the requests using this transport instead of HTTP; for example, a
+        ReplayTransport to work from a snapshot without any network access.
+        No authentication is done when a transport is provided
 
-            self.questionnaire_url = url or self.kerb_url
-            self.krbheaders = KerberosTicket("HTTP@" + urlparse(self.questionnaire_url).hostname).getAuthHeaders()
-            self.rget = partial(requests.get, headers=self.krbheaders)
-            self.rpost = partial(requests.post, headers=self.krbheaders)
+    record_to: str, optional
+        Record every response into this snapshot folder; see RecordingTransport
+
+    metrics: QuestionnaireMetrics, optional
+        Report the endpoint, latency, size and outcome of every request made to
+        the questionnaire to this object; see QuestionnaireMetrics
+
+    auth_provider: KerberosAuthProvider, optional
+        Caches and refreshes the Kerberos authentication header. Defaults to
+        the provider shared by all the clients in the process
+
+    timeout: float or tuple, optional
+        The (connect, read) timeout in seconds for each request
+
+    retries: int, optional
+        The number of times a GET that fails with a connection error, a timeout
+        or a transient status code (429, 5xx) is retried; see RetryingTransport
+
+    retry_backoff: float, optional
+        The ceiling in seconds for the jittered delay before the first retry;
+        doubled for each retry after that
+
+    limiter: AIMDConcurrencyLimiter, optional
+        Adaptively limit the number of requests in flight; see AIMDConcurrencyLimiter
+    """
+    def __init__(self, url=None, use_kerberos=True, user=None, pw=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, cache_dir=None, cache_ttls=None,
+                 cache_max_size=100*1024*1024, metadata_cache_size=64,
+                 metadata_cache_ttl=3600, transport=None, record_to=None,
+                 metrics=None, auth_provider=None, timeout=(10, 60), retries=3,
+                 retry_backoff=0.5, limiter=None):
+        if transport is not None:
+            # The transport takes care of the requests (and any authentication) itself.
+            self.session = None
+            self.questionnaire_url = url or (self.kerb_url if use_kerberos else self.wsauth_url)
+            self.identity = "transport"
+            self.transport = transport
         else:
-            self.questionnaire_url = url or self.wsauth_url
-            # Find the login information if not provided
-            user = user or getpass.getuser()
-            pw = pw or getpass.getpass()
-            self.auth = requests.auth.HTTPBasicAuth(user, pw)
-            self.rget = partial(requests.get, auth=self.auth)
-            self.rpost = partial(requests.post, auth=self.auth)
+            # requests is only imported once a client actually talks HTTP.
+            import requests
+            from requests.adapters import HTTPAdapter
+            # One session shared by all the calls so that connections to pswww are pooled and kept alive.
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            if not keep_alive:
+                self.session.headers["Connection"] = "close"
+
+            if use_kerberos:
+                self.questionnaire_url = url or self.kerb_url
+                self.auth_provider = auth_provider or sharedKerberosAuthProvider()
+                # Negotiate up front so that a missing ticket fails here rather than on the first request
+                self.auth_provider.headers(urlparse(self.questionnaire_url).hostname)
+                self.session.auth = self.auth_provider.requestsAuth()
+                self.identity = "kerberos:" + getpass.getuser()
+            else:
+                self.questionnaire_url = url or self.wsauth_url
+                # Find the login information if not provided
+                user = user or getpass.getuser()
+                pw = pw or getpass.getpass()
+                self.auth = requests.auth.HTTPBasicAuth(user, pw)
+                self.session.auth = self.auth
+                self.identity = "wsauth:" + user
+            self.transport = HTTPTransport(self.session, timeout=timeout)
+        self.metrics = metrics
+        if metrics is not None:
+            self.transport = MetricsTransport(self.transport, metrics)
+        if retries or limiter is not None:
+            # Outside of the metrics so that every attempt is counted
+            self.transport = RetryingTransport(self.transport, retries=retries, backoff=retry_backoff, limiter=limiter)
+        self.cache = ResponseCache(cache_dir, ttls=cache_ttls, max_size=cache_max_size) if cache_dir else None
+        if self.cache is not None:
+            self.transport = CachingTransport(self.transport, self.cache, self.identity)
+        if record_to:
+            # Outside of the cache so that responses served from the cache are recorded too
+            self.transport = RecordingTransport(self.transport, record_to)
+        self.transport.bind(self.questionnaire_url)
+        self.metadata = MetadataCache(max_entries=metadata_cache_size, ttl=metadata_cache_ttl)
+
+    def rget(self, url, params=None, **kwargs):
+        """
+        GET from the questionnaire; served from the on-disk cache if one is configured.
+        """
+        return self.transport.get(url, params=params, **kwargs)
+
+    def rpost(self, url, data=None, **kwargs):
+        """
+        POST to the questionnaire.
+        """
+        return self.transport.post(url, data=data, **kwargs)
+
+    def close(self):
+        """
+        Close the pooled connections held by this client.
+        """
+        self.transport.close()
+
+    def invalidate(self, run=None):
+        """
+        Drop the in-memory run scoped metadata for a run period; or for all run periods if run is None.
+        :param: run - a run period (for example, run16)
+        """
+        self.metadata.invalidate(run)
+
+    def cacheStats(self):
+        """
+        The hit/miss counters of the in-memory run scoped metadata cache.
+        """
+        return self.metadata.stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def getEnumerations(self, run):
         """
@@ -70,6 +344,9 @@ class QuestionnaireClient:
         This returns a list of proposal value names that are comboboxes.
         :param: run - a run period (for example, run16)
         """
+        return self.metadata.get(("getEnumerations", run), lambda: self._getEnumerations(run))
+
+    def _getEnumerations(self, run):
         r = self.rget(self.questionnaire_url + "ws/questionnaire/" + run + "/get_enum_field_names")
         if r.status_code <= 299:
             return r.json()
@@ -83,105 +360,258 @@ class QuestionnaireClient:
         """
         r = self.rget(self.questionnaire_url + "ws/questionnaire/experiments/" + run)
         if r.status_code <= 299:
-            experiments = r.json()
-            # experiments is a list of dicts with instrument and proposal_id
-            proposals = {}
-            for experiment in experiments["experiments"]:
-                proposals[experiment['proposal_id']] = {'Instrument': experiment['instrument'], 'proposal_id': experiment['proposal_id']}
-            return proposals
+            return self._processProposalsList(r.json())
         else:
             raise Exception("Invalid HTTP status code from server", r.status_code)
 
-    def _updateIfExists(self, ret, srcdata, srcField, destName):
-        '''Update ret if and only if the sequence of fields exists in the src data
-        :param: ret - The return dict to update
-        :param: srcdata - The source data as a dict
-        :param: srcField - The srcField in canonical format - for example, contacts.point_of_contact
-        :param: destName - The name of the field in ret. So we can take contacts.point_of_contact and create a POC field..
-        '''
-        data = srcdata
-        for field in srcField.split("."):
-            if field not in data:
-                return
-            else:
-                data =  data[field]
-        ret[destName] = data
-
-
-    def getProposalDetailsForRun(self, run, proposalid):
-        """
-        Get the detailed list of key value pairs for a proposal in a run period
-        :param: run - a run period (for example, run16)
-        :param: proposalid - the proposal id, (for example, LR01)
-        """
-        ret = {}
-        ret['proposal_id'] = proposalid
-        ret['Proposal'] = proposalid
+    def _getProposalAttributes(self, run, proposalid):
         r = self.rget(self.questionnaire_url + "ws/proposal/attribute/" + run + "/" + proposalid)
         if r.status_code <= 299:
-            proposalData = r.json()
-            # proposalData is a dict with list of dicts for the values
-            # We want the id and the val for the final dicts.
-            ret.update({x['id'] : x['val'] for x in [item for sublist in proposalData.values() for item in sublist]})
-            # Generate Beryllium lens summaries for Daniel
-            hzvr = {'vertical': 'VERT', 'horizontal' : 'HORZ'}
-            for belocid, repid in {"hutch-be-top-d": "Be-TOP",  "hutch-be-mid-d": "Be-MID", "hutch-be-bot-d": "Be-BTM", "hutch-be-sam-d": "Be-AIR"}.items():
-                tpls = sorted([(c['id'].split("-")[3].replace("d1", "1D").replace("d2", "2D"), c['id'].split("-")[4], "x", c['val']) for c in proposalData.get('hutch', []) if c['id'].startswith(belocid) and int(c['val'])], key=lambda x : (x[0], int(x[1])))
-                if tpls:
-                    h_or_v = "".join([hzvr.get(x['val'], 'VERT/HORZ') for x in proposalData['hutch'] if x['id'] == belocid.replace("-d", "-orientation")])
-                    tpls = [x + (h_or_v,) if x[0]=='1D' else x for x in tpls]
-                    ret[repid] = "  ".join(("".join(_) for _ in tpls))
-            combined_be = "\n".join(["{}:{}".format(fnl_be_attr, ret[fnl_be_attr]) for fnl_be_attr in ["Be-TOP", "Be-MID", "Be-BTM", "Be-AIR"] if fnl_be_attr in ret])
-            if combined_be:
-                ret["Be-All Beryllium Lens Stack Recipes"] = combined_be
+            return r.json()
         else:
             raise Exception("Invalid HTTP status code from server", r.status_code)
+
+    def _getProposalURAWIData(self, run, proposalid):
         r = self.rget(self.questionnaire_url + "ws/questionnaire/urawidata/" + run + "/" + proposalid)
         if r.status_code <= 299:
-            urawiData = r.json()
-            if urawiData['info']['startDate']:
-                ret.update({'StartDate': urawiData['info']['startDate']})
-            if urawiData['info']['stopDate']:
-                ret.update({'EndDate': urawiData['info']['stopDate']})
-            ret.update({"instrument": urawiData["info"]["instrument"]})
-            self._updateIfExists(ret, urawiData, "contacts.point_of_contact", "urawi_poc")
-            if 'personnel-poc-sci1' in ret:
-                ret["POC"] = ret['personnel-poc-sci1']
-            self._updateIfExists(ret, urawiData, "info.proposalTitle", "title")
-            self._updateIfExists(ret, urawiData, "info.proposalAbstract", "abstract")
-            self._updateIfExists(ret, urawiData, "info.spokesPerson.firstName", "Spokesperson First")
-            self._updateIfExists(ret, urawiData, "info.spokesPerson.lastName", "Spokesperson Last")
-            self._updateIfExists(ret, urawiData, "info.spokesPerson.email", "Spokesperson Email")
-            self._updateIfExists(ret, urawiData, "info.nonURAWI_proposal", "nonURAWI_proposal")
-            self._updateIfExists(ret, urawiData, "info.approved", "Approved")
+            return r.json()
         else:
             raise Exception("Invalid HTTP status code from server", r.status_code)
-        return ret
 
-    def formLabelMappings(self, run):
+    def getProposalDetailsForRun(self, run, proposalid, fields=None):
+        """
+        Get the detailed list of key value pairs for a proposal in a run period
+        :param: run - a run period (for example, run16)
+        :param: proposalid - the proposal id, (for example, LR01)
+        :param: fields - if provided, only the calls and computations needed for these fields are made.
+        For example, fields=["StartDate", "EndDate"] skips the attribute call and the Beryllium lens summaries.
+        The result may contain fields other than those requested.
+        """
+        needAttributes, needURAWI, needBe = self._detailsNeeded(fields)
+        proposalData = self._getProposalAttributes(run, proposalid) if needAttributes else None
+        urawiData = self._getProposalURAWIData(run, proposalid) if needURAWI else None
+        return self._combineProposalDetails(proposalid, proposalData, urawiData, needBe)
+
+    def getProposalDetailsForRunBulk(self, run, proposal_ids, max_workers=8, fields=None):
+        """
+        Get the details for many proposals in a run period concurrently.
+        Both the attribute and the URAWI calls for a proposal are issued in parallel.
+        A failure for one proposal does not abort the batch; it is reported in the returned failures.
+        :param: run - a run period (for example, run16)
+        :param: proposal_ids - an iterable of proposal ids, (for example, ["LR01", "LR02"])
+        :param: max_workers - the maximum number of requests in flight at any time
+        :param: fields - only fetch what is needed for these fields; see getProposalDetailsForRun
+        Returns a tuple (details, failures); both are dicts keyed by proposal id.
+        details has the same values as getProposalDetailsForRun; failures has the exception raised for that proposal.
+        """
+        details, failures = {}, {}
+        for proposalid, proposalDetails, error in self._iterDetails(run, proposal_ids, max_workers, False, 2*max_workers, fields):
+            if error is not None:
+                logger.warning("Failed to get details for proposal %s in %s: %s", proposalid, run, error)
+                failures[proposalid] = error
+            else:
+                details[proposalid] = proposalDetails
+        return details, failures
+
+    def _getApprovedProposalDetails(self, run, proposalid, needAttributes, needBe):
+        '''Fetch the URAWI data first and the attributes only if the proposal is approved; None if it is not approved'''
+        urawiData = self._getProposalURAWIData(run, proposalid)
+        if not self._isApproved(urawiData.get('info', {}).get('approved')):
+            return None
+        proposalData = self._getProposalAttributes(run, proposalid) if needAttributes else None
+        return self._combineProposalDetails(proposalid, proposalData, urawiData, needBe)
+
+    def _iterDetails(self, run, proposal_ids, workers, ordered, prefetch, fields=None, approved_only=False):
+        '''
+        Yield (proposalid, details, exception) tuples as the details of the proposals are fetched.
+        At most prefetch proposals are fetched ahead of the consumer; both calls for a proposal are issued in parallel.
+        With approved_only, the attribute call is only made for approved proposals and details is None for the others.
+        '''
+        needAttributes, needURAWI, needBe = self._detailsNeeded(fields)
+        proposal_ids = iter(proposal_ids)
+        # proposal id to the futures for the proposal and a function combining their results
+        inflight = OrderedDict()
+        # When unordered, the ids of the proposals whose calls have all finished; filled in by the future callbacks
+        completed = queue.Queue()
+
+        def whenAllDone(proposalid, futures):
+            pending = [len(futures)]
+            lock = threading.Lock()
+
+            def done(f):
+                with lock:
+                    pending[0] -= 1
+                    last = pending[0] == 0
+                if last:
+                    completed.put(proposalid)
+            for f in futures:
+                f.add_done_callback(done)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            def start(proposalid):
+                if approved_only:
+                    f = executor.submit(self._getApprovedProposalDetails, run, proposalid, needAttributes, needBe)
+                    futures, finish = [f], f.result
+                else:
+                    attrFuture = executor.submit(self._getProposalAttributes, run, proposalid) if needAttributes else None
+                    urawiFuture = executor.submit(self._getProposalURAWIData, run, proposalid) if needURAWI else None
+                    futures = [f for f in (attrFuture, urawiFuture) if f is not None]
+
+                    def finish():
+                        return self._combineProposalDetails(proposalid,
+                                                            attrFuture.result() if attrFuture is not None else None,
+                                                            urawiFuture.result() if urawiFuture is not None else None,
+                                                            needBe)
+                if not ordered:
+                    whenAllDone(proposalid, futures)
+                return futures, finish
+
+            def fill():
+                for proposalid in proposal_ids:
+                    if proposalid in inflight:
+                        continue
+                    inflight[proposalid] = start(proposalid)
+                    if len(inflight) >= prefetch:
+                        break
+            try:
+                fill()
+                while inflight:
+                    # Ordered, block on the oldest proposal; otherwise on the next proposal to finish
+                    proposalid = next(iter(inflight)) if ordered else completed.get()
+                    _, finish = inflight.pop(proposalid)
+                    fill()
+                    try:
+                        proposalDetails, error = finish(), None
+                    except Exception as e:
+                        proposalDetails, error = None, e
+                    yield proposalid, proposalDetails, error
+            finally:
+                # The consumer may stop early; do not fetch what has not been started yet.
+                for futures, _ in inflight.values():
+                    for f in futures:
+                        f.cancel()
+
+    def filterProposals(self, proposals, instruments=None, proposal_ids=None):
+        """
+        Filter the output of getProposalsListForRun without making any requests.
+        :param: proposals - the output of getProposalsListForRun
+        :param: instruments - only proposals for these instruments (for example, ["XPP", "XCS"]); case insensitive
+        :param: proposal_ids - only these proposal ids; these may be glob patterns (for example, ["LR*", "LU12"])
+        Returns a new dict with the selected proposals.
+        """
+        selected = proposals
+        if instruments:
+            instruments = set(x.upper() for x in instruments)
+            selected = {k: v for k, v in selected.items() if (v.get('Instrument') or '').upper() in instruments}
+        if proposal_ids:
+            selected = {k: v for k, v in selected.items() if any(fnmatch.fnmatchcase(k, pattern) for pattern in proposal_ids)}
+        return selected
+
+    def iterProposalDetails(self, run, proposal_ids=None, workers=8, ordered=False, prefetch=None, proposals=None, failures=None, fields=None,
+                            instruments=None, approved_only=False):
+        """
+        Yield the fully populated records for the proposals in a run period as their details are fetched.
+        Each record is the entry from getProposalsListForRun updated with the details from getProposalDetailsForRun.
+        Fetching runs ahead of the consumer by a bounded number of proposals so callers can process or write
+        records while the rest are being fetched.
+        :param: run - a run period (for example, run16)
+        :param: proposal_ids - the proposal ids to fetch; all the proposals in the run if None. Glob patterns (for example, LR*) are matched against the proposals in the run
+        :param: workers - the number of requests in flight at any time
+        :param: ordered - yield the records in the order of proposal_ids rather than as they complete
+        :param: prefetch - the maximum number of proposals fetched ahead of the consumer; defaults to 2*workers
+        :param: proposals - the output of getProposalsListForRun if the caller already has it
+        :param: failures - if a dict is passed, failed proposals are recorded in it (proposal id to exception) and skipped; otherwise the first failure is raised
+        :param: fields - only fetch what is needed for these fields; see getProposalDetailsForRun
+        :param: instruments - only proposals for these instruments; applied before any detail requests
+        :param: approved_only - only approved proposals; the attribute call is skipped for proposals that are not approved
+        """
+        if proposals is None:
+            proposals = self.getProposalsListForRun(run)
+        if proposal_ids is None:
+            proposal_ids = list(proposals.keys())
+        else:
+            # Expand any glob patterns against the proposals in the run
+            expanded = []
+            for pattern in proposal_ids:
+                expanded.extend(sorted(self.filterProposals(proposals, proposal_ids=[pattern]).keys()) if any(c in pattern for c in "*?[") else [pattern])
+            proposal_ids = list(OrderedDict.fromkeys(expanded))
+        if instruments:
+            selected = self.filterProposals(proposals, instruments=instruments)
+            proposal_ids = [x for x in proposal_ids if x in selected]
+        for proposalid, proposalDetails, error in self._iterDetails(run, proposal_ids, workers, ordered, prefetch or 2*workers, fields, approved_only):
+            if error is not None:
+                if failures is None:
+                    raise error
+                logger.warning("Failed to get details for proposal %s in %s: %s", proposalid, run, error)
+                failures[proposalid] = error
+                continue
+            if proposalDetails is None:
+                continue
+            record = dict(proposals.get(proposalid, {'proposal_id': proposalid}))
+            record.update(proposalDetails)
+            yield record
+
+    def formLabelMappings(self, run, max_workers=8):
         '''
         The form definitions can include optional reporting labels.
         This call generates a dict with the mapping between the attribute value name and the reporting label if one exists.
         This is also the process used to map multiple values into and array under a single reporting label.
         For example, xraytech-tech-1, xraytech-tech-2 etc will be mapped to "X-ray Techniques" as an array
+        The form definitions for the tabs are fetched concurrently using up to max_workers requests.
         '''
-        nameMappings = {}
+        return self.metadata.get(("formLabelMappings", run), lambda: self._formLabelMappings(run, max_workers))
+
+    def _getFormDefinitions(self, run, formTabName):
+        r = self.rget(self.questionnaire_url + "ws/questionnaire/" + run + "/form_data_definitions?form_name=" + formTabName)
+        if r.status_code <= 299:
+            return r.json()
+        else:
+            raise Exception("Invalid HTTP status code from server", r.status_code)
+
+    def formDefinitions(self, run, max_workers=8):
+        '''
+        Get the form definitions for all the tabs in a run period as one list, in tab order.
+        The form definitions for the tabs are fetched concurrently using up to max_workers requests.
+        :param: run - a run period (for example, run16)
+        '''
+        return self.metadata.get(("formDefinitions", run), lambda: self._formDefinitions(run, max_workers))
+
+    def _formDefinitions(self, run, max_workers):
+        allFormDefinitions = []
         tabNames = self.rget(self.questionnaire_url + "ws/questionnaire/" + run + "/tabnames").json()
-        for formTabName in tabNames:
-            logger.info("Getting form data for %s", formTabName)
-            r = self.rget(self.questionnaire_url + "ws/questionnaire/" + run + "/form_data_definitions?form_name=" + formTabName)
-            if r.status_code <= 299:
-                formDefinitions = r.json()
-                for formDefinition in formDefinitions:
-                    if 'reporting_label' in formDefinition:
-                        nameMappings[formDefinition['attribute_id']] = formDefinition['reporting_label']
-                    else:
-                        if 'quantity' in  formDefinition and int(formDefinition['quantity']) > 1:
-                            nameMappings[formDefinition['attribute_id']] = formDefinition['attribute_id'][:(formDefinition['attribute_id'].rfind("_")-1)]
-            else:
-                raise Exception("Invalid HTTP status code from server", r.status_code)
+        logger.info("Getting form data for %s tabs in %s", len(tabNames), run)
+        if not tabNames:
+            return allFormDefinitions
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tabNames)))) as executor:
+            # map preserves the tab order so later tabs override earlier ones as before.
+            for formDefinitions in executor.map(lambda formTabName: self._getFormDefinitions(run, formTabName), tabNames):
+                allFormDefinitions.extend(formDefinitions)
+        return allFormDefinitions
+
+    def _formLabelMappings(self, run, max_workers):
+        nameMappings = {}
+        self._processFormDefinitions(nameMappings, self.formDefinitions(run, max_workers))
         return nameMappings
 
+    def getLabelMapper(self, run):
+        '''
+        Compile the reporting labels for a run period into a LabelMapper; see applyLabelMappings.
+        Attributes with a quantity > 1 (for example, xraytech-tech-1, xraytech-tech-2) are grouped into an array under their reporting label.
+        :param: run - a run period (for example, run16)
+        '''
+        return self.metadata.get(("getLabelMapper", run), lambda: LabelMapper(self.formLabelMappings(run), self.formDefinitions(run)))
+
+    def applyLabelMappings(self, details, mappings):
+        '''
+        Rename the attributes of a proposal to their reporting labels.
+        :param: details - The proposal details; for example, from getProposalDetailsForRun
+        :param: mappings - Either the output of formLabelMappings or a LabelMapper from getLabelMapper.
+        Compile the mappings once using getLabelMapper when renaming many proposals.
+        '''
+        if not isinstance(mappings, LabelMapper):
+            mappings = LabelMapper(mappings)
+        return mappings.apply(details)
+
     def getProposalsStatusForRun(self, run):
         """
         Get the changes made for a proposal in a run period; we get a list of who made what change when.
@@ -201,20 +631,8 @@ class QuestionnaireClient:
         :param: run - a run period (for example, run16)
         """
         r = self.rget(self.questionnaire_url + "ws/questionnaire/proposals_personnel/" + run)
-        now = datetime.datetime.now()
         if r.status_code <= 299:
-            datas = r.json()['proposals_personnel']
-            for data in datas:
-                if data['startDate'] and data['endDate']:
-                    stdate  = datetime.datetime.strptime(data['startDate'], '%Y-%m-%d %H:%M:%S')
-                    enddate = datetime.datetime.strptime(data['endDate'],   '%Y-%m-%d %H:%M:%S')
-                    data['daysToStart'] = (stdate  - now).days
-                    data['daysToEnd']   = (enddate - now).days
-                    logger.debug("Start date %s End date %s daysToStart %s daysToEnd %s", data['startDate'], data['endDate'], data['daysToStart'], data['daysToEnd'])
-                else:
-                    data['daysToStart'] = 0
-                    data['daysToEnd']   = 0
-            return datas
+            return self._processPersonnel(r.json()['proposals_personnel'])
         else:
             raise Exception("Invalid HTTP status code from server", r.status_code)
 
@@ -254,3 +672,63 @@ class QuestionnaireClient:
             return r.json()
         else:
             raise Exception("Invalid HTTP status code from server", r.status_code)
+
+    def _unchanged(self, current, attrname, attrvalue):
+        '''The questionnaire stores the values as strings; a missing attribute is the same as an empty one'''
+        if attrname not in current:
+            return attrvalue is None or attrvalue == ""
+        return current[attrname] == attrvalue or str(current[attrname]) == str(attrvalue)
+
+    def updateProposalAttributes(self, run, updates, workers=4, skip_unchanged=True):
+        """
+        Update many attributes of many proposals in a run period.
+        The current values are fetched once per proposal and writes that would not change anything are skipped;
+        the remaining updates are POSTed concurrently using up to workers requests.
+        For example, qscli.updateProposalAttributes("run17", {"LR63": {"pcdssetup-motors-setup-1-purpose": "Value of purpose"}})
+        :param: run - a run period (for example, run16)
+        :param: updates - A dict of proposal id to a dict of attribute name to the new value
+        :param: workers - The maximum number of requests in flight
+        :param: skip_unchanged - Fetch the current values and skip the attributes that already have the new value
+        Returns a dict of proposal id to a dict of attribute name to the result of that attribute's update.
+        The result is a dict with a status of updated, unchanged or failed; the previous value, if known;
+        and for failures, the error.
+        """
+        report = {proposal_id: {} for proposal_id in updates}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            current = {}
+            if skip_unchanged:
+                futures = {proposal_id: executor.submit(self._getProposalAttributes, run, proposal_id) for proposal_id in updates}
+                for proposal_id, future in futures.items():
+                    try:
+                        values = {}
+                        self._processProposalAttributes(values, future.result(), beSummaries=False)
+                        current[proposal_id] = values
+                    except Exception as e:
+                        logger.warning("Failed to get the current attributes of %s: %s", proposal_id, e)
+                        for attrname in updates[proposal_id]:
+                            report[proposal_id][attrname] = {"status": "failed", "error": str(e)}
+
+            writes = {}
+            for proposal_id, attributes in updates.items():
+                if skip_unchanged and proposal_id not in current:
+                    continue
+                values = current.get(proposal_id, {})
+                for attrname, attrvalue in attributes.items():
+                    if skip_unchanged and self._unchanged(values, attrname, attrvalue):
+                        report[proposal_id][attrname] = {"status": "unchanged", "previous": values.get(attrname)}
+                    else:
+                        writes[(proposal_id, attrname)] = executor.submit(self.updateProposalAttribute, run, proposal_id, attrname, attrvalue)
+
+            for (proposal_id, attrname), future in writes.items():
+                result = {"status": "updated"}
+                if proposal_id in current:
+                    result["previous"] = current[proposal_id].get(attrname)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning("Failed to update %s of %s: %s", attrname, proposal_id, e)
+                    result = dict(result, status="failed", error=str(e))
+                report[proposal_id][attrname] = result
+        logger.info("Updated %s attributes of %s proposals; skipped %s unchanged", sum(1 for r in report.values() for a in r.values() if a["status"] == "updated"),
+                    len(updates), sum(1 for r in report.values() for a in r.values() if a["status"] == "unchanged"))
+        return report
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+'''
+Instrumentation of the requests made by the QuestionnaireClient.
+A MetricsTransport wraps the client's transport and reports every request to a QuestionnaireMetrics;
+this keeps per endpoint call counts, latency histograms, bytes transferred and error counts.
+The summary is written out by one or more sinks; logging, a JSON file or a Prometheus text file.
+'''
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The Prometheus client default buckets (in seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_RUN = re.compile(r'^run\d+$')
+_PROPOSAL = re.compile(r'^[A-Z]{1,3}\d+$')
+
+
+def endpointName(url, base_url=None):
+    '''
+    The endpoint for a URL; the base URL is dropped and the run periods and proposal ids are replaced by placeholders.
+    For example, .../ws/proposal/attribute/run16/LR01 is ws/proposal/attribute/{run}/{proposal}
+    '''
+    if base_url and url.startswith(base_url):
+        url = url[len(base_url):]
+    segments = url.split("?")[0].strip("/").split("/")
+    return "/".join("{run}" if _RUN.match(s) else "{proposal}" if _PROPOSAL.match(s) else s for s in segments)
+
+
+class _EndpointMetrics(object):
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.bucket_counts = [0]*(len(buckets) + 1)
+
+    def asdict(self, buckets):
+        cumulative, total = {}, 0
+        for le, c in zip([str(b) for b in buckets] + ["+Inf"], self.bucket_counts):
+            total += c
+            cumulative[le] = total
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "latency_sum": self.latency_sum,
+            "latency_max": self.latency_max,
+            "latency_avg": self.latency_sum/self.count if self.count else 0.0,
+            "buckets": cumulative,
+        }
+
+
+class QuestionnaireMetrics(object):
+    """
+    Thread safe per endpoint counters for the requests made by a QuestionnaireClient.
+
+    Parameters
+    ----------
+    sinks: list, optional
+        Objects with a write(summary) method; called by emit
+
+    buckets: tuple, optional
+        The upper bounds, in seconds, of the latency histogram buckets
+    """
+    def __init__(self, sinks=None, buckets=DEFAULT_BUCKETS):
+        self.sinks = list(sinks or [])
+        self.buckets = tuple(sorted(buckets))
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, method, endpoint, elapsed, nbytes=0, error=False):
+        '''
+        The hook called after every request.
+        :param: method - GET or POST
+        :param: endpoint - The endpoint name (see endpointName)
+        :param: elapsed - The time taken by the request in seconds
+        :param: nbytes - The size of the response body
+        :param: error - True if the request raised or returned an error status code
+        '''
+        bucket = len(self.buckets)
+        for i, le in enumerate(self.buckets):
+            if elapsed <= le:
+                bucket = i
+                break
+        with self._lock:
+            m = self._endpoints.get((method, endpoint))
+            if m is None:
+                m = self._endpoints[(method, endpoint)] = _EndpointMetrics(self.buckets)
+            m.count += 1
+            m.errors += 1 if error else 0
+            m.bytes += nbytes
+            m.latency_sum += elapsed
+            m.latency_max = max(m.latency_max, elapsed)
+            m.bucket_counts[bucket] += 1
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+            self.started = time.time()
+
+    def summary(self):
+        '''
+        The metrics as a JSON serializable dict with the totals and a entry per "METHOD endpoint".
+        '''
+        with self._lock:
+            endpoints = {method + " " + endpoint: m.asdict(self.buckets) for (method, endpoint), m in sorted(self._endpoints.items())}
+        return {
+            "elapsed": time.time() - self.started,
+            "requests": sum(e["count"] for e in endpoints.values()),
+            "errors": sum(e["errors"] for e in endpoints.values()),
+            "bytes": sum(e["bytes"] for e in endpoints.values()),
+            "latency_sum": sum(e["latency_sum"] for e in endpoints.values()),
+            "endpoints": endpoints,
+        }
+
+    def emit(self):
+        '''Write the summary to all the sinks'''
+        summary = self.summary()
+        for sink in self.sinks:
+            sink.write(summary)
+        return summary
+
+
+class MetricsTransport(object):
+    """
+    Pass the requests through to another transport and report each one to a QuestionnaireMetrics.
+
+    Parameters
+    ----------
+    inner: transport
+        The transport that makes the requests
+
+    metrics: QuestionnaireMetrics
+        Anything with a record(method, endpoint, elapsed, nbytes, error) method
+    """
+    def __init__(self, inner, metrics):
+        self.inner = inner
+        self.metrics = metrics
+        self.base_url = None
+
+    def bind(self, base_url):
+        self.base_url = base_url
+        self.inner.bind(base_url)
+
+    def _timed(self, method, call, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            r = call(url, *args, **kwargs)
+        except Exception:
+            self.metrics.record(method, endpointName(url, self.base_url), time.perf_counter() - start, 0, True)
+            raise
+        self.metrics.record(method, endpointName(url, self.base_url), time.perf_counter() - start, len(r.content or b""), r.status_code > 299 and r.status_code != 304)
+        return r
+
+    def get(self, url, params=None, **kwargs):
+        return self._timed("GET", self.inner.get, url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self._timed("POST", self.inner.post, url, data=data, **kwargs)
+
+    def close(self):
+        self.inner.close()
+
+
+def _atomicWrite(path, text):
+    tmppath = path + ".tmp"
+    with open(tmppath, 'w') as f:
+        f.write(text)
+    os.replace(tmppath, path)
+
+
+class LoggingSink(object):
+    '''Log a one line summary per endpoint'''
+    def __init__(self, log=logger, level=logging.INFO):
+        self.log = log
+        self.level = level
+
+    def write(self, summary):
+        self.log.log(self.level, "%d requests, %d errors, %d bytes in %.3fs", summary["requests"], summary["errors"], summary["bytes"], summary["elapsed"])
+        for endpoint, m in summary["endpoints"].items():
+            self.log.log(self.level, "%s: %d requests, %d errors, %d bytes, avg %.3fs, max %.3fs",
+                         endpoint, m["count"], m["errors"], m["bytes"], m["latency_avg"], m["latency_max"])
+
+
+class JSONFileSink(object):
+    '''Save the summary into a JSON file'''
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, summary):
+        _atomicWrite(self.path, json.dumps(summary, indent=2))
+
+
+class PrometheusTextFileSink(object):
+    '''
+    Save the summary in the Prometheus text exposition format; for example, for the node exporter textfile collector.
+    '''
+    def __init__(self, path, prefix="psdm_qs"):
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, summary):
+        p = self.prefix
+        lines = []
+
+        def metric(name, mtype, helptext, values):
+            lines.append("# HELP {0}_{1} {2}".format(p, name, helptext))
+            lines.append("# TYPE {0}_{1} {2}".format(p, name, mtype))
+            lines.extend(values)
+
+        def labels(endpoint, **extra):
+            method, path = endpoint.split(" ", 1)
+            pairs = [("method", method), ("endpoint", path)] + sorted(extra.items())
+            return "{" + ",".join('{0}="{1}"'.format(k, v) for k, v in pairs) + "}"
+
+        endpoints = summary["endpoints"]
+        metric("requests_total", "counter", "Requests made to the questionnaire.",
+               ["{0}_requests_total{1} {2}".format(p, labels(e), m["count"]) for e, m in endpoints.items()])
+        metric("request_errors_total", "counter", "Requests that failed or returned an error status code.",
+               ["{0}_request_errors_total{1} {2}".format(p, labels(e), m["errors"]) for e, m in endpoints.items()])
+        metric("response_bytes_total", "counter", "Bytes received from the questionnaire.",
+               ["{0}_response_bytes_total{1} {2}".format(p, labels(e), m["bytes"]) for e, m in endpoints.items()])
+        histogram = []
+        for e, m in endpoints.items():
+            histogram.extend("{0}_request_duration_seconds_bucket{1} {2}".format(p, labels(e, le=le), c) for le, c in m["buckets"].items())
+            histogram.append("{0}_request_duration_seconds_sum{1} {2}".format(p, labels(e), m["latency_sum"]))
+            histogram.append("{0}_request_duration_seconds_count{1} {2}".format(p, labels(e), m["count"]))
+        metric("request_duration_seconds", "histogram", "Latency of the requests to the questionnaire.", histogram)
+        _atomicWrite(self.path, "\n".join(lines) + "\n")
+
+
+def sinkForPath(path):
+    '''
+    The sink for a --metrics-out argument; - logs the summary, *.prom is a Prometheus text file and anything else is a JSON file.
+    '''
+    if path == "-":
+        return LoggingSink()
+    if path.endswith(".prom"):
+        return PrometheusTextFileSink(path)
+    return JSONFileSink(path)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+'''
+A local SQLite mirror of the questionnaire data.
+Runs are synced from the questionnaire using a QuestionnaireClient; cross run queries are then answered without touching the network.
+'''
+import json
+import time
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS proposals (
+    run TEXT NOT NULL,
+    proposal_id TEXT NOT NULL,
+    instrument TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    synced REAL,
+    PRIMARY KEY (run, proposal_id)
+);
+CREATE INDEX IF NOT EXISTS proposals_instrument ON proposals (instrument);
+CREATE INDEX IF NOT EXISTS proposals_start_date ON proposals (start_date);
+CREATE INDEX IF NOT EXISTS proposals_end_date ON proposals (end_date);
+
+CREATE TABLE IF NOT EXISTS attributes (
+    run TEXT NOT NULL,
+    proposal_id TEXT NOT NULL,
+    attribute_id TEXT NOT NULL,
+    val,
+    PRIMARY KEY (run, proposal_id, attribute_id)
+);
+CREATE INDEX IF NOT EXISTS attributes_attribute_id ON attributes (attribute_id, val);
+
+CREATE TABLE IF NOT EXISTS personnel (
+    run TEXT NOT NULL,
+    proposal_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS personnel_run_proposal ON personnel (run, proposal_id);
+
+CREATE TABLE IF NOT EXISTS status (
+    run TEXT NOT NULL,
+    proposal_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS status_run_proposal ON status (run, proposal_id);
+'''
+
+
+def _dbValue(val):
+    '''SQLite stores strings and numbers as is; everything else is stored as JSON'''
+    if val is None or isinstance(val, (str, int, float)):
+        return val
+    return json.dumps(val)
+
+
+class QuestionnaireMirror(object):
+    """
+    A local SQLite mirror of the questionnaire data.
+
+    Parameters
+    ----------
+    dbpath: str
+        The path to the SQLite database; created if it does not exist
+    """
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def sync(self, qs, run, workers=4):
+        '''
+        Replace the mirrored data for a run period with the current data from the questionnaire.
+        Each proposal is replaced separately; proposals no longer in the run period are removed.
+        :param: qs - A Questionnaire client
+        :param: run - a run period (for example, run16)
+        :param: workers - The number of concurrent requests used to fetch the proposal details.
+        Returns the failures from getProposalDetailsForRunBulk; the previously mirrored data for these proposals is kept.
+        '''
+        proposals = qs.getProposalsListForRun(run)
+        allDetails, failures = qs.getProposalDetailsForRunBulk(run, proposals.keys(), max_workers=workers)
+        personnel = qs.getProposalsPersonnelForRun(run)
+        status = qs.getProposalsStatusForRun(run)
+        if isinstance(status, dict):
+            status = [dict(v, proposal_id=k) if isinstance(v, dict) else {"proposal_id": k, "status": v} for k, v in status.items()]
+        now = time.time()
+        with self.conn:
+            gone = [r[0] for r in self.conn.execute("SELECT proposal_id FROM proposals WHERE run = ?", (run,)) if r[0] not in proposals]
+            for table in ["proposals", "attributes"]:
+                self.conn.executemany("DELETE FROM " + table + " WHERE run = ? AND proposal_id = ?",
+                                      [(run, proposalid) for proposalid in gone + list(allDetails)])
+            for proposalid, details in allDetails.items():
+                self.conn.execute("INSERT INTO proposals (run, proposal_id, instrument, start_date, end_date, synced) VALUES (?, ?, ?, ?, ?, ?)",
+                                  (run, proposalid, details.get("instrument") or proposals[proposalid]["Instrument"], details.get("StartDate"), details.get("EndDate"), now))
+                self.conn.executemany("INSERT INTO attributes (run, proposal_id, attribute_id, val) VALUES (?, ?, ?, ?)",
+                                      [(run, proposalid, k, _dbValue(v)) for k, v in details.items()])
+            # The personnel and status are fetched for the whole run period in one call each
+            for table in ["personnel", "status"]:
+                self.conn.execute("DELETE FROM " + table + " WHERE run = ?", (run,))
+            self.conn.executemany("INSERT INTO personnel (run, proposal_id, data) VALUES (?, ?, ?)",
+                                  [(run, p.get("proposal_id"), json.dumps(p)) for p in personnel])
+            self.conn.executemany("INSERT INTO status (run, proposal_id, data) VALUES (?, ?, ?)",
+                                  [(run, s.get("proposal_id"), json.dumps(s)) for s in status])
+        logger.info("Mirrored %s proposals for %s", len(allDetails), run)
+        return failures
+
+    def runs(self):
+        '''The run periods in the mirror'''
+        return [r[0] for r in self.conn.execute("SELECT DISTINCT run FROM proposals ORDER BY run")]
+
+    def _where(self, runs, instruments, clauses, params, prefix="p."):
+        if runs:
+            clauses.append(prefix + "run IN (" + ",".join("?"*len(runs)) + ")")
+            params.extend(runs)
+        if instruments:
+            clauses.append(prefix + "instrument IN (" + ",".join("?"*len(instruments)) + ")")
+            params.extend(instruments)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else ""
+
+    def proposals(self, runs=None, instruments=None):
+        '''
+        The proposals in the mirror as a list of dicts.
+        :param: runs - Only these run periods
+        :param: instruments - Only these instruments (for example, ["XPP", "XCS"])
+        '''
+        params = []
+        where = self._where(runs, instruments, [], params)
+        return [dict(r) for r in self.conn.execute("SELECT p.* FROM proposals p" + where + " ORDER BY p.run, p.proposal_id", params)]
+
+    def findProposals(self, attribute_id, value=None, runs=None, instruments=None):
+        '''
+        Find the proposals that have an attribute; optionally with a specific value.
+        For example, findProposals("xraytech-tech-%", "XPCS", runs=["run18", "run19"], instruments=["XPP"])
+        :param: attribute_id - The attribute id; if this contains a % it is used as a SQL LIKE pattern
+        :param: value - Only match attributes with this value
+        :param: runs - Only these run periods
+        :param: instruments - Only these instruments
+        Returns a list of dicts with the run, proposal_id, instrument, attribute_id and val
+        '''
+        params = [attribute_id]
+        clauses = ["a.attribute_id " + ("LIKE" if "%" in attribute_id else "=") + " ?"]
+        if value is not None:
+            clauses.append("a.val = ?")
+            params.append(_dbValue(value))
+        where = self._where(runs, instruments, clauses, params)
+        return [dict(r) for r in self.conn.execute("SELECT p.run, p.proposal_id, p.instrument, a.attribute_id, a.val FROM attributes a "
+                                                   "JOIN proposals p ON p.run = a.run AND p.proposal_id = a.proposal_id" + where +
+                                                   " ORDER BY p.run, p.proposal_id, a.attribute_id", params)]
+
+    def getProposalDetailsForRun(self, run, proposalid):
+        '''The mirrored equivalent of QuestionnaireClient.getProposalDetailsForRun'''
+        return {r["attribute_id"]: r["val"] for r in self.conn.execute("SELECT attribute_id, val FROM attributes WHERE run = ? AND proposal_id = ?", (run, proposalid))}
+
+    def getProposalsPersonnelForRun(self, run):
+        '''The mirrored personnel for a run period'''
+        return [json.loads(r[0]) for r in self.conn.execute("SELECT data FROM personnel WHERE run = ?", (run,))]
+
+    def getProposalsStatusForRun(self, run):
+        '''The mirrored status feed for a run period'''
+        return [json.loads(r[0]) for r in self.conn.execute("SELECT data FROM status WHERE run = ?", (run,))]
+
+    def query(self, sql, params=()):
+        '''Run an arbitrary read only SQL query against the mirror; returns a list of dicts'''
+        return [dict(r) for r in self.conn.execute(sql, params)]
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+'''
+Pluggable transports for the QuestionnaireClient.
+The HTTPTransport talks to the questionnaire; the RecordingTransport saves every response into a snapshot
+and the ReplayTransport serves the responses from a snapshot without any network access.
+The RetryingTransport retries failed GETs and optionally limits the requests in flight and
+the CachingTransport serves GETs from a ResponseCache.
+'''
+import os
+import json
+import time
+import base64
+import hashlib
+import random
+import logging
+import zipfile
+import threading
+
+from .ResponseCache import CachedResponse
+from .QuestionnaireMetrics import endpointName
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPTransport(object):
+    """
+    Make the requests using a requests.Session.
+
+    Parameters
+    ----------
+    session: requests.Session
+        The session used for all the requests
+
+    timeout: float or tuple, optional
+        The requests timeout, (connect, read) in seconds, used unless a request passes its own
+    """
+    def __init__(self, session, timeout=None):
+        self.session = session
+        self.timeout = timeout
+
+    def bind(self, base_url):
+        '''Called by the client with the questionnaire URL it uses'''
+        pass
+
+    def get(self, url, params=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, data=data, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class RetryingTransport(object):
+    """
+    Retry GETs that fail with a connection error, a timeout or a transient status code.
+    The delay before each retry is drawn uniformly from zero to an exponentially growing ceiling ("full jitter")
+    so that many workers failing together do not retry in lockstep. POSTs are not retried as they are not idempotent.
+
+    Parameters
+    ----------
+    inner: transport
+        The transport that makes the requests
+
+    retries: int, optional
+        The number of retries after the first attempt
+
+    backoff: float, optional
+        The ceiling in seconds for the delay before the first retry; doubled for every retry after that
+
+    max_backoff: float, optional
+        The largest ceiling for the delay in seconds
+
+    retry_statuses: tuple, optional
+        The HTTP status codes that are retried
+
+    limiter: AIMDConcurrencyLimiter, optional
+        Limit the requests in flight; the limiter is told of the latency and the failures of each attempt
+    """
+    def __init__(self, inner, retries=3, backoff=0.5, max_backoff=30.0, retry_statuses=(429, 500, 502, 503, 504), limiter=None):
+        self.inner = inner
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.limiter = limiter
+        self.base_url = None
+
+    def bind(self, base_url):
+        self.base_url = base_url
+        self.inner.bind(base_url)
+
+    def _attempt(self, call, url, *args, **kwargs):
+        if self.limiter is None:
+            return call(url, *args, **kwargs)
+        with self.limiter.slot():
+            start = time.perf_counter()
+            try:
+                r = call(url, *args, **kwargs)
+            except (IOError, OSError):
+                self.limiter.onCongestion()
+                raise
+            if r.status_code in self.retry_statuses:
+                self.limiter.onCongestion()
+            else:
+                self.limiter.onSuccess(time.perf_counter() - start, endpointName(url, self.base_url))
+            return r
+
+    def _delay(self, attempt, r=None):
+        retry_after = r.headers.get("Retry-After") if r is not None and getattr(r, "headers", None) else None
+        if retry_after and retry_after.isdigit():
+            return min(self.max_backoff, float(retry_after))
+        return random.uniform(0, min(self.max_backoff, self.backoff*(2**attempt)))
+
+    def get(self, url, params=None, **kwargs):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                r = self._attempt(self.inner.get, url, params=params, **kwargs)
+            except (IOError, OSError) as e:
+                # requests exceptions are IOErrors
+                if last:
+                    raise
+                delay = self._delay(attempt)
+                logger.warning("GET %s failed with %s; retrying in %.2fs", url, e, delay)
+            else:
+                if last or r.status_code not in self.retry_statuses:
+                    return r
+                delay = self._delay(attempt, r)
+                logger.warning("GET %s returned %s; retrying in %.2fs", url, r.status_code, delay)
+            time.sleep(delay)
+
+    def post(self, url, data=None, **kwargs):
+        return self._attempt(self.inner.post, url, data=data, **kwargs)
+
+    def close(self):
+        self.inner.close()
+
+
+class CachingTransport(object):
+    """
+    Serve GETs from a ResponseCache; the other requests, and GETs with extra request options, go to the inner transport.
+
+    Parameters
+    ----------
+    inner: transport
+        The transport that makes the requests
+
+    cache: ResponseCache
+        The on-disk cache
+
+    identity: str
+        The authentication identity; cached responses are never shared between identities
+    """
+    def __init__(self, inner, cache, identity=None):
+        self.inner = inner
+        self.cache = cache
+        self.identity = identity
+
+    def bind(self, base_url):
+        self.inner.bind(base_url)
+
+    def get(self, url, params=None, **kwargs):
+        if kwargs:
+            return self.inner.get(url, params=params, **kwargs)
+        return self.cache.get(self.inner.get, url, params=params, identity=self.identity)
+
+    def post(self, url, data=None, **kwargs):
+        return self.inner.post(url, data=data, **kwargs)
+
+    def close(self):
+        self.inner.close()
+
+
+class _SnapshotTransport(object):
+    '''The naming of the responses in a snapshot; shared by the recording and the replay transports'''
+    base_url = None
+
+    def bind(self, base_url):
+        self.base_url = base_url
+
+    def _name(self, method, url, params=None, data=None):
+        if self.base_url and url.startswith(self.base_url):
+            url = url[len(self.base_url):]
+        keysrc = json.dumps([method, url, sorted((params or {}).items()), sorted((data or {}).items())], default=str)
+        return hashlib.sha256(keysrc.encode("utf-8")).hexdigest() + ".json"
+
+
+class RecordingTransport(_SnapshotTransport):
+    """
+    Pass the requests through to another transport and record every response into a snapshot directory.
+
+    Parameters
+    ----------
+    inner: transport
+        The transport that makes the requests; usually a HTTPTransport
+
+    snapshot_dir: str
+        The folder to save the responses into; created if it does not exist
+    """
+    def __init__(self, inner, snapshot_dir):
+        self.inner = inner
+        self.snapshot_dir = snapshot_dir
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+
+    def bind(self, base_url):
+        super(RecordingTransport, self).bind(base_url)
+        self.inner.bind(base_url)
+
+    def _record(self, name, method, url, params, data, r):
+        record = {
+            "method": method,
+            "url": url,
+            "params": params,
+            "data": data,
+            "status_code": r.status_code,
+            "content": base64.b64encode(r.content).decode("ascii"),
+        }
+        path = os.path.join(self.snapshot_dir, name)
+        tmppath = path + ".tmp." + str(threading.current_thread().ident)
+        with open(tmppath, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmppath, path)
+
+    def get(self, url, params=None, **kwargs):
+        r = self.inner.get(url, params=params, **kwargs)
+        self._record(self._name("GET", url, params), "GET", url, params, None, r)
+        return r
+
+    def post(self, url, data=None, **kwargs):
+        r = self.inner.post(url, data=data, **kwargs)
+        self._record(self._name("POST", url, None, data), "POST", url, None, data, r)
+        return r
+
+    def close(self):
+        self.inner.close()
+
+
+class ReplayTransport(_SnapshotTransport):
+    """
+    Serve the responses from a snapshot made by a RecordingTransport; there is no network access at all.
+    Requests that are not in the snapshot raise an Exception.
+
+    Parameters
+    ----------
+    snapshot: str
+        Either the snapshot folder or a zip archive of it (see archiveSnapshot)
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self._zip = zipfile.ZipFile(snapshot) if zipfile.is_zipfile(snapshot) else None
+        self._lock = threading.Lock()
+
+    def _read(self, name):
+        try:
+            if self._zip is not None:
+                with self._lock:
+                    return json.loads(self._zip.read(name).decode("utf-8"))
+            with open(os.path.join(self.snapshot, name), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, KeyError):
+            return None
+
+    def _replay(self, method, url, params=None, data=None):
+        record = self._read(self._name(method, url, params, data))
+        if record is None:
+            raise Exception("Request not in snapshot", method, url, params)
+        return CachedResponse(record["status_code"], base64.b64decode(record["content"]))
+
+    def get(self, url, params=None, **kwargs):
+        return self._replay("GET", url, params=params)
+
+    def post(self, url, data=None, **kwargs):
+        return self._replay("POST", url, data=data)
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+
+def archiveSnapshot(snapshot_dir, archive_path):
+    '''
+    Pack a snapshot folder into a zip archive that the ReplayTransport can read directly.
+    :param: snapshot_dir - The folder used by the RecordingTransport
+    :param: archive_path - The zip file to create
+    '''
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(os.listdir(snapshot_dir)):
+            if name.endswith(".json"):
+                zf.write(os.path.join(snapshot_dir, name), name)
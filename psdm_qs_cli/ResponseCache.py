@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+'''
+An optional on-disk cache for the Questionnaire web service responses.
+Only the slow changing run period metadata is cached; see ResponseCache.default_ttls.
+'''
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse(object):
+    """
+    A minimal stand in for requests.Response for responses read back from disk.
+    """
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of GET responses keyed by the URL and the identity of the caller.
+
+    Parameters
+    ----------
+    cache_dir: str
+        The folder used to store the responses; created if it does not exist
+
+    ttls: list, optional
+        A list of (url fragment, seconds) pairs. The first fragment found in a URL
+        determines how long the response is considered fresh. URLs that do not
+        match any fragment are not cached. Defaults to default_ttls
+
+    max_size: int, optional
+        The maximum size of the cache in bytes. The least recently used responses
+        are evicted once this is exceeded
+    """
+    default_ttls = [
+        ("/tabnames", 24*3600),
+        ("/form_data_definitions", 24*3600),
+        ("/get_enum_field_names", 24*3600),
+        ("/getURAWIProposalIds", 3600),
+    ]
+
+    def __init__(self, cache_dir, ttls=None, max_size=100*1024*1024):
+        self.cache_dir = cache_dir
+        self.ttls = self.default_ttls if ttls is None else ttls
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def ttlFor(self, url):
+        '''The time to live in seconds for this URL; None if this URL is not to be cached'''
+        for fragment, ttl in self.ttls:
+            if fragment in url:
+                return ttl
+        return None
+
+    def _key(self, url, params, identity):
+        keysrc = json.dumps([url, sorted((params or {}).items()), identity])
+        return hashlib.sha256(keysrc.encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, key + ".meta"), os.path.join(self.cache_dir, key + ".body")
+
+    def _load(self, key):
+        metapath, bodypath = self._paths(key)
+        try:
+            with open(metapath, 'r') as f:
+                meta = json.load(f)
+            with open(bodypath, 'rb') as f:
+                content = f.read()
+        except (IOError, OSError, ValueError):
+            return None, None
+        return meta, content
+
+    def _writeFile(self, path, data, mode):
+        tmppath = path + ".tmp." + str(threading.current_thread().ident)
+        with open(tmppath, mode) as f:
+            f.write(data)
+        os.replace(tmppath, path)
+
+    def _store(self, key, url, response):
+        metapath, bodypath = self._paths(key)
+        meta = {
+            "url": url,
+            "stored": time.time(),
+            "status_code": response.status_code,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        self._writeFile(bodypath, response.content, 'wb')
+        self._writeFile(metapath, json.dumps(meta), 'w')
+        self._evict()
+
+    def _touch(self, key, meta=None):
+        metapath, bodypath = self._paths(key)
+        try:
+            if meta is not None:
+                self._writeFile(metapath, json.dumps(meta), 'w')
+            os.utime(bodypath, None)
+        except OSError:
+            pass
+
+    def _evict(self):
+        '''Remove the least recently used responses until the cache is within max_size'''
+        with self._lock:
+            entries, total = [], 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".body"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name[:-len(".body")]))
+                total += st.st_size
+            for _, size, key in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for path in self._paths(key):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+
+    def get(self, fetch, url, params=None, identity=None):
+        '''
+        Get the response for url either from the cache or by calling fetch.
+        :param: fetch - A callable fetch(url, params=..., headers=...) that makes the HTTP request, for example, session.get
+        :param: url - The URL
+        :param: params - Any query parameters
+        :param: identity - The authentication identity; responses are never shared between identities
+        '''
+        ttl = self.ttlFor(url)
+        if ttl is None:
+            return fetch(url, params=params)
+        key = self._key(url, params, identity)
+        meta, content = self._load(key)
+        if meta is not None and time.time() - meta["stored"] < ttl:
+            logger.debug("Cache hit for %s", url)
+            self._touch(key)
+            return CachedResponse(meta["status_code"], content)
+
+        conditional = {}
+        if meta is not None:
+            if meta.get("etag"):
+                conditional["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                conditional["If-Modified-Since"] = meta["last_modified"]
+        r = fetch(url, params=params, headers=conditional) if conditional else fetch(url, params=params)
+        if r.status_code == 304 and meta is not None:
+            logger.debug("Cache revalidated for %s", url)
+            meta["stored"] = time.time()
+            self._touch(key, meta)
+            return CachedResponse(meta["status_code"], content)
+        if r.status_code <= 299:
+            self._store(key, url, r)
+        return r
+
+    def clear(self):
+        '''Remove all the cached responses'''
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".meta") or name.endswith(".body"):
+                    os.remove(os.path.join(self.cache_dir, name))
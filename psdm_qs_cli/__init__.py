@@ -1,5 +1,16 @@
 from .QuestionnaireClient import QuestionnaireClient
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+
+def __getattr__(name):
+    # The version (which may shell out to git in a source checkout) and the asyncio client (which imports aiohttp)
+    # are only loaded when asked for so that importing the package stays cheap. Module __getattr__ needs Python 3.7 (PEP 562).
+    if name == "__version__":
+        from ._version import get_versions
+        globals()["__version__"] = get_versions()['version']
+        return globals()["__version__"]
+    if name == "AsyncQuestionnaireClient":
+        # The module is not named after the class so that importing it never rebinds this name to the module.
+        from .AsyncQuestionnaire import AsyncQuestionnaireClient
+        globals()["AsyncQuestionnaireClient"] = AsyncQuestionnaireClient
+        return AsyncQuestionnaireClient
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
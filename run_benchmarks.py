@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+'''
+End-to-end benchmarks of the JSON and Excel exporters against the local MockQuestionnaireServer.
+Each export runs in a fresh process so that the peak RSS is that of the export alone.
+The results are saved as JSON so that runs from different commits can be compared, for example
+
+    python run_benchmarks.py --output before.json
+    git checkout my-branch
+    python run_benchmarks.py --output after.json --compare before.json
+'''
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+from psdm_qs_cli.MockQuestionnaireServer import MockQuestionnaireServer, generateSyntheticRun
+
+ATTRIBUTES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports", "xray_only.json")
+
+
+def _export(exporter, url, run, workers, outdir, results):
+    '''Run one export in this (child) process and put the wall clock time and the peak RSS on the results queue'''
+    import resource
+    from psdm_qs_cli import QuestionnaireClient
+    logging.disable(logging.INFO)
+    sys.stdout = open(os.devnull, 'w')
+    qs = QuestionnaireClient(url, use_kerberos=False, user="bench", pw="bench", pool_maxsize=max(10, 2*workers))
+    start = time.time()
+    if exporter == "json":
+        from psdm_qs_cli.QSGenerateJSON import generateJSONDocumentForRun
+        generateJSONDocumentForRun(qs, run, True, os.path.join(outdir, run + ".json"), workers=workers)
+    else:
+        from psdm_qs_cli.QSGenerateExcelSpreadSheet import generateExcelSpreadSheetForRun
+        generateExcelSpreadSheetForRun(qs, run, ATTRIBUTES_FILE, os.path.join(outdir, run + ".xlsx"), workers=workers)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({"wall_clock": elapsed, "peak_rss_mb": maxrss / (1024.0*1024.0 if sys.platform == "darwin" else 1024.0)})
+
+
+def _waitForResult(p, results, poll=1.0):
+    '''The result of the export process; raises an Exception if the process exits without putting one on the queue'''
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            if not p.is_alive():
+                # The result may have been put just before the process exited
+                try:
+                    return results.get(timeout=poll)
+                except queue.Empty:
+                    raise Exception("The export process failed", p.exitcode)
+
+
+def benchmark(exporter, size, latency, workers, attributes):
+    run = "run{}".format(size)
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    with MockQuestionnaireServer({run: generateSyntheticRun(run, size, attributes)}, latency=latency) as server:
+        with tempfile.TemporaryDirectory() as outdir:
+            p = ctx.Process(target=_export, args=(exporter, server.url, run, workers, outdir, results))
+            p.start()
+            result = _waitForResult(p, results)
+            p.join()
+        result.update({
+            "exporter": exporter,
+            "proposals": size,
+            "requests": server.requests_served,
+            "bytes": server.bytes_served,
+            "proposals_per_sec": size / result["wall_clock"] if result["wall_clock"] else None,
+        })
+    return result
+
+
+def importTime(repeat=5):
+    '''The best of a few wall clock times to import the package and the exporters in a fresh interpreter'''
+    script = ("import time; start = time.perf_counter(); import psdm_qs_cli, psdm_qs_cli.QSGenerateJSON, psdm_qs_cli.QSGenerateExcelSpreadSheet; "
+              "print(time.perf_counter() - start)")
+    return min(float(subprocess.check_output([sys.executable, "-c", script]).decode().strip().splitlines()[-1]) for _ in range(repeat))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    '''Print the change in wall clock time for each benchmark in both results'''
+    if previous.get("import_time") and current.get("import_time"):
+        print("import            : {:8.3f}s -> {:8.3f}s ({:+.1f}%)".format(
+            previous["import_time"], current["import_time"], 100.0*(current["import_time"] - previous["import_time"])/previous["import_time"]))
+    before = {(r["exporter"], r["proposals"]): r for r in previous["results"]}
+    for r in current["results"]:
+        p = before.get((r["exporter"], r["proposals"]))
+        if p:
+            print("{:6s} {:6d} proposals: {:8.3f}s -> {:8.3f}s ({:+.1f}%)".format(
+                r["exporter"], r["proposals"], p["wall_clock"], r["wall_clock"], 100.0*(r["wall_clock"] - p["wall_clock"])/p["wall_clock"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the exporters against a local mock questionnaire')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help="The number of proposals in each benchmarked run.")
+    parser.add_argument('--exporters', nargs='+', default=["json", "excel"], choices=["json", "excel"])
+    parser.add_argument('--attributes', type=int, default=50, help="The number of free form attributes per proposal.")
+    parser.add_argument('--latency', type=float, default=0.005, help="The average server latency per request in seconds.")
+    parser.add_argument('--workers', type=int, default=8, help="The number of proposals to fetch concurrently.")
+    parser.add_argument('--output', default="benchmark_results.json", help="Save the results into this JSON file.")
+    parser.add_argument('--compare', help="Compare against the results in this JSON file.")
+    args = parser.parse_args()
+
+    current = {
+        "commit": _commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "parameters": {"latency": args.latency, "workers": args.workers, "attributes": args.attributes},
+        "import_time": importTime(),
+        "results": [],
+    }
+    print("import            : {:8.3f}s".format(current["import_time"]))
+    for exporter in args.exporters:
+        for size in args.sizes:
+            result = benchmark(exporter, size, args.latency, args.workers, args.attributes)
+            print("{exporter:6s} {proposals:6d} proposals: {wall_clock:8.3f}s {requests:6d} requests {peak_rss_mb:8.1f}MB {proposals_per_sec:8.1f} proposals/s".format(**result))
+            current["results"].append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=2)
+    print("Saved results into", args.output)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), current)
+
+
+if __name__ == '__main__':
+    main()
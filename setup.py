@@ -14,10 +14,13 @@ setup(
     author_email="mshankar@slac.stanford.edu",
     license="MIT",
     packages=["psdm_qs_cli"],
+    python_requires=">=3.7",
     entry_points={
         "console_scripts": [
             "QSGenerateExcelSpreadSheet.py=psdm_qs_cli.QSGenerateExcelSpreadSheet:main",
             "QSGenerateJSON.py=psdm_qs_cli.QSGenerateJSON:main",
+            "QSMirror.py=psdm_qs_cli.QSMirror:main",
+            "QSMockServer.py=psdm_qs_cli.MockQuestionnaireServer:main",
         ],
     },
     install_requires=requirements,
@@ -1,2 +1,730 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def mock_questionnaire():
+    '''
+    Start a MockQuestionnaireServer with a synthetic run18 and make a client for it.
+    Call with the number of proposals, any MockQuestionnaireServer options and client_options for the QuestionnaireClient;
+    returns the server and the client. The servers are stopped at the end of the test.
+    '''
+    from psdm_qs_cli import QuestionnaireClient
+    from psdm_qs_cli.MockQuestionnaireServer import MockQuestionnaireServer, generateSyntheticRun
+    servers = []
+
+    def start(num_proposals=4, client_options=None, **server_options):
+        server = MockQuestionnaireServer({"run18": generateSyntheticRun("run18", num_proposals=num_proposals)}, **server_options).start()
+        servers.append(server)
+        options = {"use_kerberos": False, "user": "u", "pw": "p"}
+        options.update(client_options or {})
+        return server, QuestionnaireClient(server.url, **options)
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
 def test_import():
     import psdm_qs_cli
+
+
+def test_pooled_session():
+    from psdm_qs_cli import QuestionnaireClient
+    qs = QuestionnaireClient("http://localhost/", use_kerberos=False, user="u", pw="p",
+                             pool_maxsize=4, keep_alive=False)
+    adapter = qs.session.get_adapter("https://pswww.slac.stanford.edu/")
+    assert adapter._pool_maxsize == 4
+    assert qs.session.auth is qs.auth
+    assert qs.session.headers["Connection"] == "close"
+    qs.close()
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+
+def fake_get(url, *args, **kwargs):
+    proposalid = url.rsplit("/", 1)[-1]
+    if proposalid == "BAD":
+        return FakeResponse({}, status_code=500)
+    if "/ws/proposal/attribute/" in url:
+        return FakeResponse({"hutch": [{"id": "personnel-poc-sci1", "val": "poc"}]})
+    return FakeResponse({"info": {"startDate": "2020-01-01 00:00:00", "stopDate": None, "instrument": "XPP"}})
+
+
+def test_bulk_details():
+    from psdm_qs_cli import QuestionnaireClient
+    qs = QuestionnaireClient("http://localhost/", use_kerberos=False, user="u", pw="p")
+    qs.rget = fake_get
+    details, failures = qs.getProposalDetailsForRunBulk("run18", ["LR01", "BAD"], max_workers=2)
+    assert list(failures) == ["BAD"]
+    assert details["LR01"] == qs.getProposalDetailsForRun("run18", "LR01")
+    assert details["LR01"]["POC"] == "poc"
+    assert details["LR01"]["instrument"] == "XPP"
+
+
+def test_response_cache(tmpdir):
+    from psdm_qs_cli.ResponseCache import ResponseCache
+    calls = []
+
+    class Response(FakeResponse):
+        headers = {"ETag": "v1"}
+        content = b'["tab1", "tab2"]'
+
+    def fetch(url, params=None, headers=None):
+        calls.append(headers)
+        return Response(None, status_code=304 if headers else 200)
+
+    cache = ResponseCache(str(tmpdir), ttls=[("/tabnames", 0), ("/get_enum_field_names", 60)])
+    url = "https://localhost/ws/questionnaire/run18/tabnames"
+    assert cache.get(fetch, url, identity="u").status_code == 200
+    # Expired immediately, so revalidated using the ETag
+    assert cache.get(fetch, url, identity="u").json() == ["tab1", "tab2"]
+    assert calls == [None, {"If-None-Match": "v1"}]
+    # Not shared between identities
+    cache.get(fetch, url, identity="other")
+    assert calls[-1] is None
+    # Fresh entries are served without a request
+    enumurl = "https://localhost/ws/questionnaire/run18/get_enum_field_names"
+    cache.get(fetch, enumurl)
+    cache.get(fetch, enumurl)
+    assert len(calls) == 4
+    cache.max_size = 0
+    cache._evict()
+    assert not tmpdir.listdir()
+
+
+def test_metadata_cache():
+    from psdm_qs_cli.MetadataCache import MetadataCache
+    cache = MetadataCache(max_entries=2, ttl=None)
+    assert cache.get(("enum", "run17"), lambda: [1]) == [1]
+    assert cache.get(("enum", "run17"), lambda: [2]) == [1]
+    cache.get(("enum", "run18"), lambda: [3])
+    cache.get(("enum", "run19"), lambda: [4])
+    assert cache.stats()["evictions"] == 1
+    cache.invalidate("run18")
+    assert cache.get(("enum", "run18"), lambda: [5]) == [5]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 4
+
+
+def test_form_label_mappings():
+    from psdm_qs_cli import QuestionnaireClient
+    qs = QuestionnaireClient("http://localhost/", use_kerberos=False, user="u", pw="p")
+
+    def get(url, *args, **kwargs):
+        if url.endswith("/tabnames"):
+            return FakeResponse(["tab1", "tab2", "tab3"])
+        tab = url.rsplit("=", 1)[-1]
+        return FakeResponse([{"attribute_id": "shared", "reporting_label": tab},
+                             {"attribute_id": tab + "-attr", "reporting_label": "Label " + tab}])
+    qs.rget = get
+    mappings = qs.formLabelMappings("run18", max_workers=3)
+    assert mappings["shared"] == "tab3"
+    assert mappings["tab2-attr"] == "Label tab2"
+    assert qs.formLabelMappings("run18") == mappings
+    assert qs.cacheStats()["hits"] == 1
+
+
+def test_incremental_json_export(tmpdir, mock_questionnaire):
+    from psdm_qs_cli.QSGenerateJSON import generateJSONDocumentForRun
+    path = str(tmpdir.join("run18.json"))
+    server, qs = mock_questionnaire(3)
+    generateJSONDocumentForRun(qs, "run18", False, path, incremental=True)
+    server.runs["run18"]["status"][1]["modified_time"] = "2030-01-01 00:00:00"
+    server.runs["run18"]["proposals"]["LB0001"]["urawi"]["info"]["proposalTitle"] = "Changed"
+    server.runs["run18"]["proposals"]["LC0002"]["urawi"]["info"]["proposalTitle"] = "Not refetched"
+    server.resetCounters()
+    generateJSONDocumentForRun(qs, "run18", False, path, incremental=True)
+    # The status and the list of proposals and then the details of the one changed proposal
+    assert server.requests_served == 4
+    with open(path) as f:
+        exported = json.load(f)
+    assert exported["LB0001"]["title"] == "Changed"
+    assert exported["LC0002"]["title"] == "Synthetic proposal LC0002"
+    assert exported["LA0000"]["Instrument"] == "AMO"
+
+    # A changed proposal that cannot be refetched keeps its last good data and is retried by the next export
+    server.runs["run18"]["status"][0]["modified_time"] = "2030-01-01 00:00:00"
+    server.runs["run18"]["proposals"]["LA0000"]["urawi"]["info"]["proposalTitle"] = "Changed"
+    handle = server.handle
+    server.handle = lambda method, parts, query, form: (404, {"error": "Gone"}) if "LA0000" in parts else handle(method, parts, query, form)
+    assert list(generateJSONDocumentForRun(qs, "run18", False, path, incremental=True)) == ["LA0000"]
+    with open(path) as f:
+        assert json.load(f)["LA0000"]["title"] == "Synthetic proposal LA0000"
+    server.handle = handle
+    server.resetCounters()
+    assert generateJSONDocumentForRun(qs, "run18", False, path, incremental=True) == {}
+    assert server.requests_served == 4
+    with open(path) as f:
+        assert json.load(f)["LA0000"]["title"] == "Changed"
+
+
+def test_mirror(tmpdir):
+    from psdm_qs_cli.QuestionnaireMirror import QuestionnaireMirror
+
+    class Client(object):
+        def __init__(self, technique="XPCS", failing=()):
+            self.technique = technique
+            self.failing = failing
+
+        def getProposalsListForRun(self, run):
+            return {"LR01": {"Instrument": "XPP"}, "LR02": {"Instrument": "XCS"}}
+
+        def getProposalDetailsForRunBulk(self, run, proposal_ids, max_workers=1):
+            return ({pid: {"instrument": self.getProposalsListForRun(run)[pid]["Instrument"], "xraytech-tech-1": self.technique, "Approved": True} for pid in proposal_ids if pid not in self.failing},
+                    {pid: IOError("Network blip") for pid in self.failing})
+
+        def getProposalsPersonnelForRun(self, run):
+            return [{"proposal_id": "LR01", "startDate": None}]
+
+        def getProposalsStatusForRun(self, run):
+            return [{"proposal_id": "LR01"}]
+
+    with QuestionnaireMirror(str(tmpdir.join("mirror.sqlite"))) as mirror:
+        for run in ["run18", "run19"]:
+            mirror.sync(Client(), run)
+        mirror.sync(Client(), "run19")
+        assert mirror.runs() == ["run18", "run19"]
+        found = mirror.findProposals("xraytech-tech-%", "XPCS", runs=["run19"], instruments=["XPP"])
+        assert [(r["run"], r["proposal_id"]) for r in found] == [("run19", "LR01")]
+        assert mirror.getProposalDetailsForRun("run18", "LR02")["instrument"] == "XCS"
+        assert mirror.getProposalsPersonnelForRun("run18") == [{"proposal_id": "LR01", "startDate": None}]
+        # The proposals that could not be fetched keep their previously mirrored data
+        assert list(mirror.sync(Client("SAXS", failing=["LR02"]), "run18")) == ["LR02"]
+        assert mirror.getProposalDetailsForRun("run18", "LR01")["xraytech-tech-1"] == "SAXS"
+        assert mirror.getProposalDetailsForRun("run18", "LR02")["xraytech-tech-1"] == "XPCS"
+        assert [p["proposal_id"] for p in mirror.proposals(runs=["run18"])] == ["LR01", "LR02"]
+
+
+def test_record_and_replay(tmpdir):
+    from psdm_qs_cli import QuestionnaireClient
+    from psdm_qs_cli.QuestionnaireTransport import RecordingTransport, ReplayTransport, archiveSnapshot
+    from psdm_qs_cli.ResponseCache import CachedResponse
+
+    class Transport(object):
+        def bind(self, base_url):
+            pass
+
+        def get(self, url, params=None, **kwargs):
+            r = fake_get(url)
+            return CachedResponse(r.status_code, json.dumps(r.data).encode("utf-8"))
+
+        def close(self):
+            pass
+
+    snapshot = str(tmpdir.join("snapshot"))
+    qs = QuestionnaireClient("http://localhost/", transport=RecordingTransport(Transport(), snapshot))
+    recorded = qs.getProposalDetailsForRun("run18", "LR01")
+    archive = str(tmpdir.join("snapshot.zip"))
+    archiveSnapshot(snapshot, archive)
+    for source in [snapshot, archive]:
+        replayed = QuestionnaireClient("http://otherhost/", transport=ReplayTransport(source))
+        assert replayed.getProposalDetailsForRun("run18", "LR01") == recorded
+
+
+def test_record_on_warm_cache(tmpdir, mock_questionnaire):
+    from psdm_qs_cli import QuestionnaireClient
+    from psdm_qs_cli.QSGenerateJSON import generateJSONDocumentForRun
+    from psdm_qs_cli.QuestionnaireTransport import ReplayTransport
+    cache_dir, snapshot = str(tmpdir.join("cache")), str(tmpdir.join("snapshot"))
+    server, qs = mock_questionnaire(client_options={"cache_dir": cache_dir})
+    generateJSONDocumentForRun(qs, "run18", True, str(tmpdir.join("warm.json")))
+    # The metadata is served from the cache while recording
+    qs = QuestionnaireClient(server.url, use_kerberos=False, user="u", pw="p", cache_dir=cache_dir, record_to=snapshot)
+    generateJSONDocumentForRun(qs, "run18", True, str(tmpdir.join("recorded.json")))
+    replayed = QuestionnaireClient("http://otherhost/", transport=ReplayTransport(snapshot))
+    generateJSONDocumentForRun(replayed, "run18", True, str(tmpdir.join("replayed.json")))
+    with open(str(tmpdir.join("recorded.json"))) as f1, open(str(tmpdir.join("replayed.json"))) as f2:
+        assert json.load(f1) == json.load(f2)
+
+
+def test_mock_server(mock_questionnaire):
+    server, qs = mock_questionnaire(5)
+    proposals = qs.getProposalsListForRun("run18")
+    assert len(proposals) == 5
+    details, failures = qs.getProposalDetailsForRunBulk("run18", proposals.keys())
+    assert not failures
+    assert details["LA0000"]["title"] == "Synthetic proposal LA0000"
+    assert "Be-All Beryllium Lens Stack Recipes" in details["LA0000"]
+    assert qs.formLabelMappings("run18")["xraytech-tech-2"] == "X-ray Techniques"
+    qs.updateProposalAttribute("run18", "LA0000", "pcdssetup-motors-setup-1-purpose", "Purpose")
+    assert qs.getProposalDetailsForRun("run18", "LA0000")["pcdssetup-motors-setup-1-purpose"] == "Purpose"
+    # Clearing an attribute
+    qs.updateProposalAttribute("run18", "LA0000", "pcdssetup-motors-setup-1-purpose", "")
+    assert qs.getProposalDetailsForRun("run18", "LA0000")["pcdssetup-motors-setup-1-purpose"] == ""
+    assert qs.session.post(server.url + "ws/proposal/attribute/run18/LA0000", data={"id": "pcdssetup-motors-setup-1-purpose"}).status_code == 400
+    assert qs.lookupByExperimentName("amola000018")["proposal_id"] == "LA0000"
+
+
+def test_apply_label_mappings():
+    from psdm_qs_cli import QuestionnaireClient
+    qs = QuestionnaireClient("http://localhost/", use_kerberos=False, user="u", pw="p")
+    details = {"proposal_id": "LR01", "personnel-poc-sci1": "poc", "general-attr-0": "x"}
+    mapped = qs.applyLabelMappings(details, {"personnel-poc-sci1": "Scientific POC lead"})
+    assert mapped == {"proposal_id": "LR01", "Scientific POC lead": "poc", "general-attr-0": "x"}
+
+
+def test_grouped_label_mappings():
+    from psdm_qs_cli.LabelMapper import LabelMapper
+    formDefinitions = [{"attribute_id": "xraytech-tech-{}".format(i), "reporting_label": "X-ray Techniques", "quantity": "3"} for i in range(1, 4)]
+    mapper = LabelMapper({d["attribute_id"]: d["reporting_label"] for d in formDefinitions}, formDefinitions)
+    assert mapper.groups == {"X-ray Techniques": ["xraytech-tech-1", "xraytech-tech-2", "xraytech-tech-3"]}
+    mapped = mapper.apply({"xraytech-tech-3": "XAS", "xraytech-tech-1": "XPCS", "xraytech-tech-2": "", "proposal_id": "LR01"})
+    assert mapped == {"X-ray Techniques": ["XPCS", "XAS"], "proposal_id": "LR01"}
+
+
+def test_ndjson_export(tmpdir, mock_questionnaire):
+    from psdm_qs_cli.QSGenerateJSON import generateNDJSONDocumentForRun, readNDJSON
+    path = str(tmpdir.join("run18.ndjson"))
+    server, qs = mock_questionnaire(5)
+    generateNDJSONDocumentForRun(qs, "run18", True, path, workers=2, flushEvery=2)
+    with open(path, 'a') as f:
+        f.write('{"proposal_id": "trunc')
+    records = list(readNDJSON(path))
+    assert sorted(r["proposal_id"] for r in records) == ["LA0000", "LB0001", "LC0002", "LD0003", "LE0004"]
+    assert "X-ray Techniques" in records[0]
+    generateNDJSONDocumentForRun(qs, "run18", False, path, flushEvery=0)
+    assert len(list(readNDJSON(path))) == 5
+
+
+def test_ndjson_resume(tmpdir, mock_questionnaire):
+    from psdm_qs_cli.QSGenerateJSON import generateNDJSONDocumentForRun, readNDJSON
+    path = str(tmpdir.join("run18.ndjson"))
+    server, qs = mock_questionnaire(5)
+    iterProposalDetails = qs.iterProposalDetails
+
+    def dies(*args, **kwargs):
+        for i, record in enumerate(iterProposalDetails(*args, **kwargs)):
+            if i == 2:
+                raise IOError("Network blip")
+            yield record
+    qs.iterProposalDetails = dies
+    with pytest.raises(IOError):
+        generateNDJSONDocumentForRun(qs, "run18", False, path, flushEvery=1)
+    qs.iterProposalDetails = iterProposalDetails
+    with open(path, 'a') as f:
+        f.write('{"proposal_id": "trunc')
+    server.resetCounters()
+    generateNDJSONDocumentForRun(qs, "run18", False, path, resume=True)
+    # The list of proposals and then the details of the 3 remaining proposals
+    assert server.requests_served == 1 + 2*3
+    with open(path) as f:
+        assert sorted(json.loads(line)["proposal_id"] for line in f) == ["LA0000", "LB0001", "LC0002", "LD0003", "LE0004"]
+    # A document from a different export is not resumed
+    generateNDJSONDocumentForRun(qs, "run18", False, path, approvedOnly=True, resume=True)
+    assert sorted(r["proposal_id"] for r in readNDJSON(path)) == ["LA0000", "LB0001", "LC0002", "LE0004"]
+
+
+def test_iter_proposal_details(mock_questionnaire):
+    server, qs = mock_questionnaire(20, latency=0.002)
+    ids = sorted(qs.getProposalsListForRun("run18").keys(), reverse=True)
+    records = list(qs.iterProposalDetails("run18", ids, workers=4, ordered=True))
+    assert [r["proposal_id"] for r in records] == ids
+    assert records[0]["Instrument"] == records[0]["instrument"]
+    failures = {}
+    unordered = list(qs.iterProposalDetails("run18", ids[:3] + ["NOPE"], workers=4, failures=failures))
+    assert sorted(r["proposal_id"] for r in unordered) == sorted(ids[:3])
+    assert list(failures) == ["NOPE"]
+    # Stopping early does not fetch the whole run
+    server.resetCounters()
+    records = qs.iterProposalDetails("run18", ids, workers=2, prefetch=2)
+    next(records)
+    records.close()
+    assert server.requests_served < 20
+
+
+def test_iter_proposal_details_does_not_spin(mock_questionnaire):
+    import time
+    server, qs = mock_questionnaire(16, latency=0.1)
+    # The consumer blocks until a proposal is done rather than polling its futures
+    start = time.thread_time()
+    records = list(qs.iterProposalDetails("run18", workers=4))
+    assert len(records) == 16
+    assert time.thread_time() - start < 0.2
+
+
+def test_field_projection(mock_questionnaire):
+    server, qs = mock_questionnaire(4)
+    full = qs.getProposalDetailsForRun("run18", "LA0000")
+    server.resetCounters()
+    dates = qs.getProposalDetailsForRun("run18", "LA0000", fields=["proposal_id", "StartDate", "Approved"])
+    assert server.requests_served == 1
+    assert dates["StartDate"] == full["StartDate"] and "personnel-poc-sci1" not in dates
+    server.resetCounters()
+    personnel = qs.getProposalDetailsForRun("run18", "LA0000", fields=["personnel-poc-sci1", "POC"])
+    assert server.requests_served == 1
+    assert personnel["POC"] == full["POC"] and "Be-TOP" not in personnel
+    server.resetCounters()
+    records = list(qs.iterProposalDetails("run18", fields=["personnel-poc-sci2"]))
+    assert len(records) == 4 and server.requests_served == 5
+
+
+def test_filters(mock_questionnaire):
+    server, qs = mock_questionnaire(16)
+    proposals = qs.getProposalsListForRun("run18")
+    assert sorted(qs.filterProposals(proposals, instruments=["xpp"])) == ["LC0002", "LJ0009"]
+    server.resetCounters()
+    records = list(qs.iterProposalDetails("run18", ["L?000*", "LJ0009"], proposals=proposals, instruments=["XPP"]))
+    assert sorted(r["proposal_id"] for r in records) == ["LC0002", "LJ0009"]
+    assert server.requests_served == 4
+    # Every 4th synthetic proposal is not approved
+    server.resetCounters()
+    records = list(qs.iterProposalDetails("run18", proposals=proposals, approved_only=True))
+    assert len(records) == 12 and all(r["Approved"] for r in records)
+    assert server.requests_served == 16 + 12
+
+
+def test_metrics(tmpdir, mock_questionnaire):
+    from psdm_qs_cli.QuestionnaireMetrics import QuestionnaireMetrics, JSONFileSink, PrometheusTextFileSink
+    jsonpath, prompath = str(tmpdir.join("metrics.json")), str(tmpdir.join("metrics.prom"))
+    metrics = QuestionnaireMetrics([JSONFileSink(jsonpath), PrometheusTextFileSink(prompath)])
+    server, qs = mock_questionnaire(3, client_options={"metrics": metrics})
+    qs.getProposalDetailsForRun("run18", "LA0000")
+    qs.getProposalDetailsForRun("run18", "LB0001")
+    try:
+        qs.getProposalDetailsForRun("run18", "NOPE")
+    except Exception:
+        pass
+    summary = metrics.emit()
+    attrs = summary["endpoints"]["GET ws/proposal/attribute/{run}/{proposal}"]
+    assert attrs["count"] == 2 and attrs["buckets"]["+Inf"] == 2 and attrs["bytes"] > 0
+    assert summary["errors"] >= 1
+    with open(jsonpath) as f:
+        assert json.load(f)["requests"] == summary["requests"]
+    with open(prompath) as f:
+        assert 'psdm_qs_requests_total{method="GET",endpoint="ws/proposal/attribute/{run}/{proposal}"} 2' in f.read()
+
+
+def test_export_profiler(mock_questionnaire):
+    import io
+    from psdm_qs_cli.QuestionnaireMetrics import QuestionnaireMetrics
+    from psdm_qs_cli.ExportProfiler import ExportProfiler
+    out = io.StringIO()
+    server, qs = mock_questionnaire(4, client_options={"metrics": QuestionnaireMetrics()})
+    with ExportProfiler(profile=True, trace_memory=True, metrics=qs.metrics, limit=5, out=out):
+        list(qs.iterProposalDetails("run18", workers=2))
+    report = out.getvalue()
+    assert "HTTP wait (all threads)" in report and "9 requests" in report
+    assert "_getProposalAttributes" in report or "function calls" in report
+    assert "Traced memory" in report
+
+
+def test_import_time():
+    import sys
+    import subprocess
+
+    def importTime(modules):
+        # Measured in a fresh interpreter; the best of a few runs to drop the noise of a loaded machine.
+        script = ("import sys, time, json; start = time.perf_counter(); import " + modules + "; "
+                  "print(json.dumps([time.perf_counter() - start, [m for m in ('requests', 'krtc', 'openpyxl', 'aiohttp', 'psdm_qs_cli._version') if m in sys.modules]]))")
+        runs = [json.loads(subprocess.check_output([sys.executable, "-c", script]).decode().strip().splitlines()[-1]) for i in range(3)]
+        return min(elapsed for elapsed, loaded in runs), runs[0][1]
+    elapsed, loaded = importTime("psdm_qs_cli, psdm_qs_cli.QSGenerateExcelSpreadSheet")
+    # The optional and heavy dependencies must not be imported until they are used
+    assert loaded == []
+    # Every import used to pay for requests (and krtc, openpyxl and a git probe); the budget is relative to
+    # importing requests alone so that it does not depend on the speed of the machine.
+    assert elapsed < importTime("requests")[0]
+
+
+def test_async_client_import_order():
+    import sys
+    import subprocess
+    # Importing the asyncio client's module first must not hide the class behind the module in the package
+    script = ("import inspect, psdm_qs_cli.AsyncQuestionnaire; from psdm_qs_cli import AsyncQuestionnaireClient; "
+              "print(inspect.isclass(AsyncQuestionnaireClient))")
+    assert subprocess.check_output([sys.executable, "-c", script]).decode().strip() == "True"
+    import psdm_qs_cli
+    from psdm_qs_cli.AsyncQuestionnaire import AsyncQuestionnaireClient
+    assert psdm_qs_cli.AsyncQuestionnaireClient is AsyncQuestionnaireClient
+
+
+def test_async_client(mock_questionnaire):
+    import asyncio
+    import threading
+    import time
+    pytest.importorskip("aiohttp")
+    from psdm_qs_cli import AsyncQuestionnaireClient
+    server, qs = mock_questionnaire(num_proposals=8)
+    # Track the requests being handled at once by the server
+    handle, lock, inflight = server.handle, threading.Lock(), [0, 0]
+
+    def handleSlowly(*args):
+        with lock:
+            inflight[0] += 1
+            inflight[1] = max(inflight[1], inflight[0])
+        try:
+            time.sleep(0.02)
+            return handle(*args)
+        finally:
+            with lock:
+                inflight[0] -= 1
+    server.handle = handleSlowly
+
+    proposals = sorted(qs.getProposalsListForRun("run18"))
+    experiment = sorted(qs.getExpName2URAWIProposalIDs())[0]
+    expected = [
+        qs.getEnumerations("run18"),
+        qs.getProposalsListForRun("run18"),
+        [qs.getProposalDetailsForRun("run18", p) for p in proposals],
+        qs.formLabelMappings("run18"),
+        qs.getProposalsStatusForRun("run18"),
+        qs.getProposalsPersonnelForRun("run18"),
+        qs.getExpName2URAWIProposalIDs(),
+        qs.lookupByExperimentName(experiment),
+    ]
+    inflight[1] = 0
+
+    async def run():
+        async with AsyncQuestionnaireClient(server.url, use_kerberos=False, user="u", pw="p", max_concurrency=2) as aqs:
+            results = await asyncio.gather(
+                aqs.getEnumerations("run18"),
+                aqs.getProposalsListForRun("run18"),
+                asyncio.gather(*[aqs.getProposalDetailsForRun("run18", p) for p in proposals]),
+                aqs.formLabelMappings("run18"),
+                aqs.getProposalsStatusForRun("run18"),
+                aqs.getProposalsPersonnelForRun("run18"),
+                aqs.getExpName2URAWIProposalIDs(),
+                aqs.lookupByExperimentName(experiment))
+            updated = await aqs.updateProposalAttribute("run18", proposals[0], "pcdssetup-motors-setup-1-purpose", "async")
+            return list(results), updated
+    results, updated = asyncio.run(run())
+    results[2] = list(results[2])
+    assert results == expected
+    assert inflight[1] == 2
+    assert updated == qs.updateProposalAttribute("run18", proposals[1], "pcdssetup-motors-setup-1-purpose", "sync")
+    assert qs.getProposalDetailsForRun("run18", proposals[0])["pcdssetup-motors-setup-1-purpose"] == "async"
+
+
+def test_kerberos_auth_provider(mock_questionnaire):
+    import threading
+    from psdm_qs_cli import QuestionnaireClient
+    from psdm_qs_cli.KerberosAuth import KerberosAuthProvider
+    tokens = iter(range(1000))
+    provider = KerberosAuthProvider(negotiate=lambda host: {"Authorization": "Negotiate " + str(next(tokens))})
+    valid = {"Negotiate 0"}
+    server, qs1 = mock_questionnaire(4, client_options={"auth_provider": provider, "use_kerberos": True}, accept_auth=lambda h: h in valid)
+    qs2 = QuestionnaireClient(server.url, auth_provider=provider)
+    qs1.getProposalsListForRun("run18")
+    qs2.getProposalsListForRun("run18")
+    assert provider.negotiations == 1
+    # The server stops accepting the token; every thread retries once and only one renegotiates
+    valid = {"Negotiate 1"}
+    threads = [threading.Thread(target=qs1.getProposalDetailsForRun, args=("run18", "LA0000")) for i in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert qs2.getProposalDetailsForRun("run18", "LB0001")["proposal_id"] == "LB0001"
+    assert provider.negotiations == 2
+    # Headers older than max_age are renegotiated proactively
+    provider.max_age = 0
+    valid = {"Negotiate 2", "Negotiate 3"}
+    qs1.getProposalsListForRun("run18")
+    assert provider.negotiations >= 3
+
+
+def test_async_client_negotiates_off_the_event_loop(mock_questionnaire):
+    import time
+    import asyncio
+    pytest.importorskip("aiohttp")
+    from psdm_qs_cli import AsyncQuestionnaireClient
+    from psdm_qs_cli.KerberosAuth import KerberosAuthProvider
+
+    def negotiate(host):
+        time.sleep(0.3)
+        return {"Authorization": "Negotiate"}
+    provider = KerberosAuthProvider(negotiate=negotiate)
+    server, qs = mock_questionnaire()
+    aqs = AsyncQuestionnaireClient(server.url, auth_provider=provider)
+    # Renegotiate on every request
+    provider.max_age = 0
+
+    async def run():
+        request, ticks = asyncio.ensure_future(aqs.getEnumerations("run18")), 0
+        while not request.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        await aqs.close()
+        return request.result(), ticks
+    enumerations, ticks = asyncio.run(run())
+    assert enumerations == qs.getEnumerations("run18")
+    assert ticks >= 10
+
+
+def test_retries_and_limiter(mock_questionnaire):
+    from psdm_qs_cli.ConcurrencyLimiter import AIMDConcurrencyLimiter
+    limiter = AIMDConcurrencyLimiter(initial=4, maximum=8)
+    server, qs = mock_questionnaire(20, client_options={"retries": 8, "retry_backoff": 0.001, "limiter": limiter}, error_rate=0.2, seed=1)
+    failures = {}
+    records = list(qs.iterProposalDetails("run18", workers=8, failures=failures))
+    assert len(records) == 20 and not failures
+    assert server.errors_served > 0 and limiter.inflight == 0
+
+    limiter = AIMDConcurrencyLimiter(initial=4, maximum=8)
+    for i in range(100):
+        limiter.onSuccess(0.01)
+    assert limiter.limit == 8
+    limiter.onCongestion()
+    limiter.onCongestion()
+    # Only cut once for the requests that were already in flight
+    assert limiter.limit == 4
+    for i in range(10):
+        limiter.onSuccess(0.1)
+    assert limiter.limit < 4
+
+
+def test_limiter_on_a_jittery_server(mock_questionnaire):
+    from psdm_qs_cli.ConcurrencyLimiter import AIMDConcurrencyLimiter
+    limiter = AIMDConcurrencyLimiter(initial=4, maximum=8)
+    # The mock server's latency varies by +/-50%; this alone is not congestion
+    server, qs = mock_questionnaire(100, client_options={"limiter": limiter}, latency=0.02)
+    details, failures = qs.getProposalDetailsForRunBulk("run18", qs.getProposalsListForRun("run18").keys(), max_workers=8)
+    assert len(details) == 100 and not failures
+    assert limiter.limit >= 7
+
+
+def test_resume_export(tmpdir, mock_questionnaire):
+    import os
+    from psdm_qs_cli.QSGenerateJSON import generateJSONDocumentForRun
+    path = str(tmpdir.join("run18.json"))
+    server, qs = mock_questionnaire(8)
+    iterProposalDetails = qs.iterProposalDetails
+
+    def dies(*args, **kwargs):
+        for i, record in enumerate(iterProposalDetails(*args, **kwargs)):
+            if i == 5:
+                raise IOError("Network blip")
+            yield record
+    qs.iterProposalDetails = dies
+    with pytest.raises(IOError):
+        generateJSONDocumentForRun(qs, "run18", False, path)
+    assert os.path.exists(path + ".checkpoint") and not os.path.exists(path)
+    qs.iterProposalDetails = iterProposalDetails
+    server.resetCounters()
+    generateJSONDocumentForRun(qs, "run18", False, path, resume=True)
+    # The list of proposals and then the details of the 3 remaining proposals
+    assert server.requests_served == 1 + 2*3
+    assert not os.path.exists(path + ".checkpoint")
+    with open(path) as f:
+        assert sorted(json.load(f)) == ["LA0000", "LB0001", "LC0002", "LD0003", "LE0004", "LF0005", "LG0006", "LH0007"]
+
+
+# The write-only workbook of the interrupted export complains when it is garbage collected; collected in the test
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_excel_export(tmpdir, mock_questionnaire):
+    import gc
+    pytest.importorskip("openpyxl")
+    import openpyxl
+    from psdm_qs_cli.QSGenerateExcelSpreadSheet import generateExcelSpreadSheetForRun
+    attributes = [{"attr": "instrument", "label": "Instrument"}, {"attr": "StartDate", "label": "Start Date"},
+                  {"attr": "general-attr-3", "label": "General 3"}, {"attr": "pcdssetup-motors-setup-1-purpose", "label": "Motors"}]
+    attributes_file, path = str(tmpdir.join("attributes.json")), str(tmpdir.join("run18.xlsx"))
+    with open(attributes_file, 'w') as f:
+        json.dump(attributes, f)
+    server, qs = mock_questionnaire(8)
+    columns = ["proposal_id"] + [a["attr"] for a in attributes]
+
+    def rows():
+        ws = openpyxl.load_workbook(path)["run18"]
+        return [list(row) for row in ws.iter_rows(max_col=len(columns), values_only=True)]
+
+    generateExcelSpreadSheetForRun(qs, "run18", attributes_file, path, workers=4)
+    # The list of proposals and then the attributes and URAWI data of each proposal
+    assert server.requests_served == 1 + 2*8
+    written = rows()
+    assert written[0] == ["Proposal", "Instrument", "Start Date", "General 3", "Motors"]
+    proposals = sorted(qs.getProposalsListForRun("run18"))
+    expected = [[qs.getProposalDetailsForRun("run18", p).get(c) for c in columns] for p in proposals]
+    assert written[1:] == expected
+    # No purpose has been set for any proposal; these are blank cells
+    assert all(row[-1] is None for row in written[1:])
+
+    # Resume an export that was interrupted after completing some of the proposals in the middle of the run
+    iterProposalDetails = qs.iterProposalDetails
+
+    def dies(*args, **kwargs):
+        for record in iterProposalDetails(*args, **kwargs):
+            yield record
+        raise IOError("Network blip")
+    qs.iterProposalDetails = dies
+    with pytest.raises(IOError) as interrupted:
+        generateExcelSpreadSheetForRun(qs, "run18", attributes_file, path, proposal_ids=["LB0001", "LE0004", "LG0006"])
+    del interrupted
+    gc.collect()
+    qs.iterProposalDetails = iterProposalDetails
+    server.resetCounters()
+    generateExcelSpreadSheetForRun(qs, "run18", attributes_file, path, resume=True)
+    assert server.requests_served == 1 + 2*5
+    assert rows()[1:] == expected
+
+
+def test_exporters_exit_non_zero_on_failures(tmpdir, monkeypatch, mock_questionnaire):
+    import os
+    import sys
+    from psdm_qs_cli import QSGenerateJSON, QSGenerateExcelSpreadSheet
+    server, qs = mock_questionnaire(8)
+    handle = server.handle
+
+    def failsForLB0001(method, parts, query, form):
+        return (500, {"error": "Broken proposal"}) if "LB0001" in parts else handle(method, parts, query, form)
+    server.handle = failsForLB0001
+    monkeypatch.setattr("getpass.getpass", lambda *args: "p")
+    common = ["--no_kerberos", "--no-cache", "--retries", "0", "--questionnaire_url", server.url, "run18"]
+    for module, args, path in [(QSGenerateJSON, [], "run18.json"), (QSGenerateJSON, ["--format", "ndjson"], "run18.ndjson"),
+                               (QSGenerateExcelSpreadSheet, ["--user", "u", "--password", "p"], "run18.xlsx")]:
+        path = str(tmpdir.join(path))
+        extra = [os.path.join(os.path.dirname(__file__), "..", "reports", "xray_only.json")] if module is QSGenerateExcelSpreadSheet else []
+        monkeypatch.setattr(sys, "argv", ["export"] + args + common + extra + [path])
+        # The other proposals are still saved
+        with pytest.raises(SystemExit) as exited:
+            module.main()
+        assert exited.value.code == 1
+        assert os.path.exists(path)
+
+
+def test_resume_after_failures(tmpdir, mock_questionnaire):
+    import os
+    from psdm_qs_cli.QSGenerateJSON import generateJSONDocumentForRun
+    from psdm_qs_cli.QSGenerateExcelSpreadSheet import generateExcelSpreadSheetForRun
+    server, qs = mock_questionnaire(8, client_options={"retries": 0})
+    handle = server.handle
+
+    def failsForLB0001(method, parts, query, form):
+        return (500, {"error": "Broken proposal"}) if "LB0001" in parts else handle(method, parts, query, form)
+    attributes_file = os.path.join(os.path.dirname(__file__), "..", "reports", "xray_only.json")
+    for path, export in [(str(tmpdir.join("run18.json")), lambda path, resume: generateJSONDocumentForRun(qs, "run18", False, path, resume=resume)),
+                         (str(tmpdir.join("run18.xlsx")), lambda path, resume: generateExcelSpreadSheetForRun(qs, "run18", attributes_file, path, resume=resume))]:
+        server.handle = failsForLB0001
+        assert list(export(path, False)) == ["LB0001"]
+        # The checkpoint is kept so that only the failed proposal is fetched again
+        assert os.path.exists(path) and os.path.exists(path + ".checkpoint")
+        server.handle = handle
+        server.resetCounters()
+        assert export(path, True) == {}
+        assert server.requests_served == 1 + 2
+        assert not os.path.exists(path + ".checkpoint")
+
+
+def test_update_proposal_attributes(mock_questionnaire):
+    server, qs = mock_questionnaire(4)
+    current = qs.getProposalDetailsForRun("run18", "LA0000")
+    server.resetCounters()
+    report = qs.updateProposalAttributes("run18", {
+        "LA0000": {"pcdssetup-motors-setup-1-purpose": "Alignment", "personnel-poc-sci1": current["personnel-poc-sci1"]},
+        "LB0001": {"pcdssetup-motors-setup-1-purpose": "Scan", "pcdssetup-motors-setup-2-purpose": ""},
+        "NOPE": {"pcdssetup-motors-setup-1-purpose": "Nothing"},
+    }, workers=4)
+    # One GET per proposal and only the two real changes are written
+    assert server.requests_served == 3 + 2
+    assert report["LA0000"]["pcdssetup-motors-setup-1-purpose"]["status"] == "updated"
+    assert report["LA0000"]["personnel-poc-sci1"] == {"status": "unchanged", "previous": current["personnel-poc-sci1"]}
+    assert report["LB0001"]["pcdssetup-motors-setup-2-purpose"]["status"] == "unchanged"
+    assert report["NOPE"]["pcdssetup-motors-setup-1-purpose"]["status"] == "failed"
+    assert qs.getProposalDetailsForRun("run18", "LB0001")["pcdssetup-motors-setup-1-purpose"] == "Scan"